@@ -237,6 +237,82 @@ void print_detector_detections(FILE **fps, char *id, detection *dets, int total,
     }
 }
 
+/* eval=vocbin: one binary file for all classes instead of a text file per class.
+ * A detfile_header, then one detfile_record per detection and class with a
+ * nonzero prob, then the image ids (basecfg of each valid path, indexed by
+ * record.image) and the class names, each newline terminated. Boxes are the
+ * 1-based clamped corners print_detector_detections writes. */
+typedef struct {
+    char magic[4];
+    int version;
+    long long count;
+    long long names_offset;
+    int images;
+    int classes;
+} detfile_header;
+
+typedef struct {
+    int image;
+    int cls;
+    float score;
+    float xmin, ymin, xmax, ymax;
+} detfile_record;
+
+static FILE *open_detector_bin(char *filename)
+{
+    detfile_header header = {{'D', 'K', 'D', 'T'}, 1, 0, 0, 0, 0};
+    FILE *fp = fopen(filename, "wb");
+    if(!fp){
+        fprintf(stderr, "Couldn't open file: %s\n", filename);
+        exit(0);
+    }
+    fwrite(&header, sizeof(header), 1, fp);
+    return fp;
+}
+
+static int print_detector_bin(FILE *fp, int image, detection *dets, int total, int classes, int w, int h)
+{
+    int i, j;
+    int count = 0;
+    for(i = 0; i < total; ++i){
+        float xmin = dets[i].bbox.x - dets[i].bbox.w/2. + 1;
+        float xmax = dets[i].bbox.x + dets[i].bbox.w/2. + 1;
+        float ymin = dets[i].bbox.y - dets[i].bbox.h/2. + 1;
+        float ymax = dets[i].bbox.y + dets[i].bbox.h/2. + 1;
+
+        if (xmin < 1) xmin = 1;
+        if (ymin < 1) ymin = 1;
+        if (xmax > w) xmax = w;
+        if (ymax > h) ymax = h;
+
+        for(j = 0; j < classes; ++j){
+            if (dets[i].prob[j]){
+                detfile_record r = {image, j, dets[i].prob[j], xmin, ymin, xmax, ymax};
+                fwrite(&r, sizeof(r), 1, fp);
+                ++count;
+            }
+        }
+    }
+    return count;
+}
+
+static void close_detector_bin(FILE *fp, long long count, char **paths, int m, char **names, int classes)
+{
+    int i;
+    detfile_header header = {{'D', 'K', 'D', 'T'}, 1, count, ftell(fp), m, classes};
+    for(i = 0; i < m; ++i){
+        char *id = basecfg(paths[i]);
+        fprintf(fp, "%s\n", id);
+        free(id);
+    }
+    for(i = 0; i < classes; ++i){
+        fprintf(fp, "%s\n", names[i]);
+    }
+    fseek(fp, 0, SEEK_SET);
+    fwrite(&header, sizeof(header), 1, fp);
+    fclose(fp);
+}
+
 void print_imagenet_detections(FILE *fp, int id, detection *dets, int total, int classes, int w, int h)
 {
     int i, j;
@@ -289,6 +365,8 @@ void validate_detector_flip(char *datacfg, char *cfgfile, char *weightfile, char
     FILE **fps = 0;
     int coco = 0;
     int imagenet = 0;
+    int bin = 0;
+    long long nbin = 0;
     if(0==strcmp(type, "coco")){
         if(!outfile) outfile = "coco_results";
         snprintf(buff, 1024, "%s/%s.json", prefix, outfile);
@@ -301,6 +379,11 @@ void validate_detector_flip(char *datacfg, char *cfgfile, char *weightfile, char
         fp = fopen(buff, "w");
         imagenet = 1;
         classes = 200;
+    } else if(0==strcmp(type, "vocbin")){
+        if(!outfile) outfile = "comp4_det_test";
+        snprintf(buff, 1024, "%s/%s.bin", prefix, outfile);
+        fp = open_detector_bin(buff);
+        bin = 1;
     } else {
         if(!outfile) outfile = "comp4_det_test_";
         fps = calloc(classes, sizeof(FILE *));
@@ -371,6 +454,8 @@ void validate_detector_flip(char *datacfg, char *cfgfile, char *weightfile, char
                 print_cocos(fp, path, dets, num, classes, w, h);
             } else if (imagenet){
                 print_imagenet_detections(fp, i+t-nthreads+1, dets, num, classes, w, h);
+            } else if (bin){
+                nbin += print_detector_bin(fp, i+t-nthreads, dets, num, classes, w, h);
             } else {
                 print_detector_detections(fps, id, dets, num, classes, w, h);
             }
@@ -388,6 +473,9 @@ void validate_detector_flip(char *datacfg, char *cfgfile, char *weightfile, char
         fprintf(fp, "\n]\n");
         fclose(fp);
     }
+    if(bin){
+        close_detector_bin(fp, nbin, paths, m, names, classes);
+    }
     fprintf(stderr, "Total Detection Time: %f Seconds\n", what_time_is_it_now() - start);
     log_error("Total Detection Time: %f Seconds\n", what_time_is_it_now() - start);
 }
@@ -427,6 +515,8 @@ void validate_detector(char *datacfg, char *cfgfile, char *weightfile, char *out
     FILE **fps = 0;
     int coco = 0;
     int imagenet = 0;
+    int bin = 0;
+    long long nbin = 0;
     if(0==strcmp(type, "coco")){
         if(!outfile) outfile = "coco_results";
         snprintf(buff, 1024, "%s/%s.json", prefix, outfile);
@@ -439,6 +529,11 @@ void validate_detector(char *datacfg, char *cfgfile, char *weightfile, char *out
         fp = fopen(buff, "w");
         imagenet = 1;
         classes = 200;
+    } else if(0==strcmp(type, "vocbin")){
+        if(!outfile) outfile = "comp4_det_test";
+        snprintf(buff, 1024, "%s/%s.bin", prefix, outfile);
+        fp = open_detector_bin(buff);
+        bin = 1;
     } else {
         if(!outfile) outfile = "comp4_det_test_";
         fps = calloc(classes, sizeof(FILE *));
@@ -507,6 +602,8 @@ void validate_detector(char *datacfg, char *cfgfile, char *weightfile, char *out
                 print_cocos(fp, path, dets, nboxes, classes, w, h);
             } else if (imagenet){
                 print_imagenet_detections(fp, i+t-nthreads+1, dets, nboxes, classes, w, h);
+            } else if (bin){
+                nbin += print_detector_bin(fp, i+t-nthreads, dets, nboxes, classes, w, h);
             } else {
                 print_detector_detections(fps, id, dets, nboxes, classes, w, h);
             }
@@ -524,6 +621,9 @@ void validate_detector(char *datacfg, char *cfgfile, char *weightfile, char *out
         fprintf(fp, "\n]\n");
         fclose(fp);
     }
+    if(bin){
+        close_detector_bin(fp, nbin, paths, m, names, classes);
+    }
     fprintf(stderr, "Total Detection Time: %f Seconds\n", what_time_is_it_now() - start);
     log_info("Total Detection Time: %f Seconds\n", what_time_is_it_now() - start);
 }
@@ -757,9 +757,15 @@ int network_height(network *net);
 float *network_predict_image(network *net, image im);
 void network_detect(network *net, image im, float thresh, float hier_thresh, float nms, detection *dets);
 detection *get_network_boxes(network *net, int w, int h, float thresh, float hier, int *map, int relative, int *num);
+int num_detections(network *net, float thresh);   //lrt
+detection *make_network_boxes(network *net, float thresh, int *num);   //lrt
+void fill_network_boxes(network *net, int w, int h, float thresh, float hier, int *map, int relative, detection *dets);   //lrt
+int fill_network_boxes_batch(network *net, int b, int w, int h, float thresh, float hier, int *map, int relative, detection *dets);   //lrt
 void free_detections(detection *dets, int n);
+void get_detection_probs(detection *dets, int n, int classes, float *probs);   //lrt
 
 void reset_network_state(network *net, int b);
+void reorder_network_state(network *net, int *index, int n);   //lrt
 
 char **get_labels(char *filename);
 void do_nms_obj(detection *dets, int total, int classes, float thresh);
@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+"""CPU benchmarks for the python inference paths.
+
+Builds nothing itself: point --so at a CPU-only libdarknet (shell/bench.sh
+builds one). For every model a workspace gets a voc.data, a random
+weights file and a synthetic JPEG corpus, then each mode runs in its own
+process so peak RSS is per mode; the nms mode instead times the C and
+numpy NMS engines on the same low-threshold outputs. Results go to a JSON
+baseline; with --baseline the run is compared against an earlier one and
+exits 1 when throughput drops by more than --tolerance.
+"""
+import os
+import sys
+import json
+import time
+import struct
+import socket
+import argparse
+import resource
+import subprocess
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+MODELS = {'yolov3-tiny': 'cfg/yolov3-tiny.cfg',
+          'yolov2-tiny-voc': 'cfg/yolov2-tiny-voc.cfg',
+          'yolov3': 'cfg/yolov3.cfg',
+          'darknet': 'cfg/darknet.cfg'}
+#yolov3 is slow on a CPU, ask for it with --models; darknet is the
+#imagenet classifier, for the classify modes
+DEFAULT_MODELS = ['yolov2-tiny-voc', 'yolov3-tiny']
+MODES = ['i', 'p', 'p_pipeline', 'p_batch', 'e', 'c', 'classify', 'classify_batch', 'nms', 'letterbox']
+#NMS engines of the nms mode; C ones by function, numpy ones by nms.NMS mode,
+#each numpy mode checked against the C function it mirrors
+NMS_ENGINES = [('c', 'obj', None), ('c_sort', 'class', None),
+               ('obj', 'obj', 'c'), ('class', 'class', 'c_sort'), ('soft', 'soft', None)]
+
+ZLOG_CONF = '''[formats]
+simple = "%m"
+[rules]
+my_cat.* "{0}"; simple
+'''
+
+def read_cfg(cfgfile):
+    """[(section, {key: value})] of a darknet cfg."""
+    sections = []
+    with open(cfgfile, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                sections.append((line.strip('[]'), {}))
+            else:
+                key, value = line.split('=', 1)
+                sections[-1][1][key.strip()] = value.strip()
+    return sections
+
+def gen_weights(cfgfile, weightfile, seed=0, head_bias=-4., residual_scale=.1):
+    """Random weights that keep activations finite through the network.
+
+    Convolutions get He-normal weights and neutral batchnorm statistics;
+    the convolutions right before a yolo/region layer start at head_bias
+    so the untrained network yields a realistic number of boxes rather
+    than one per anchor. Residual branches (the convolution before a
+    shortcut) get a batchnorm scale of residual_scale, or deep networks
+    like yolov3 blow up to infinite boxes.
+    """
+    rng = np.random.RandomState(seed)
+    sections = read_cfg(cfgfile)
+    c = int(sections[0][1].get('channels', 3))
+    channels = []
+    with open(weightfile, 'wb') as f:
+        #major, minor, revision, seen
+        f.write(struct.pack('<iiiQ', 0, 2, 0, 0))
+        for i, (kind, opts) in enumerate(sections[1:]):
+            if kind in ('convolutional', 'conv'):
+                n = int(opts['filters'])
+                size = int(opts.get('size', 1))
+                groups = int(opts.get('groups', 1))
+                fan_in = c // groups * size * size
+                after = sections[i + 2][0] if i + 2 < len(sections) else None
+                np.full(n, head_bias if after in ('yolo', 'region') else 0., dtype=np.float32).tofile(f)
+                if int(opts.get('batch_normalize', 0)):
+                    np.full(n, residual_scale if after == 'shortcut' else 1., dtype=np.float32).tofile(f)
+                    np.zeros(n, dtype=np.float32).tofile(f)
+                    np.ones(n, dtype=np.float32).tofile(f)
+                (rng.standard_normal(n * fan_in) * np.sqrt(2. / fan_in)).astype(np.float32).tofile(f)
+                c = n
+            elif kind == 'route':
+                layers = [int(l) for l in opts['layers'].split(',')]
+                c = sum(channels[l if l >= 0 else len(channels) + l] for l in layers)
+            elif kind in ('connected', 'local', 'rnn', 'gru', 'lstm', 'crnn', 'deconvolutional', 'batchnorm'):
+                raise ValueError("{0}: no random weights for [{1}] layers".format(cfgfile, kind))
+            channels.append(c)
+
+def gen_corpus(path, count, width, height, seed=0):
+    import cv2
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    rng = np.random.RandomState(seed)
+    files = []
+    for i in range(count):
+        img = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        for k in range(8):
+            x, y = rng.randint(0, width), rng.randint(0, height)
+            color = tuple(int(v) for v in rng.randint(0, 256, 3))
+            cv2.rectangle(img, (x, y), (x + rng.randint(8, width // 3), y + rng.randint(8, height // 3)), color, -1)
+        f = os.path.join(path, 'bench_{0:05d}.jpg'.format(i))
+        cv2.imwrite(f, img)
+        files.append(f)
+    return files
+
+def prepare(work, model, images, width, height):
+    """Workspace for one model; returns its voc.data and the corpus directory."""
+    cfgfile = os.path.join(ROOT, MODELS[model])
+    base = os.path.join(work, model)
+    backup = os.path.join(base, 'backup')
+    if not os.path.isdir(backup):
+        os.makedirs(backup)
+    sections = read_cfg(cfgfile)
+    heads = [int(o['classes']) for kind, o in sections if kind in ('yolo', 'region')]
+    #a classifier has as many classes as its last convolution has filters
+    classes = heads[-1] if heads else [int(o['filters']) for kind, o in sections if kind == 'convolutional'][-1]
+
+    names = os.path.join(base, 'bench.names')
+    with open(names, 'w') as f:
+        f.write(''.join('class{0}\n'.format(i) for i in range(classes)))
+    zlog = os.path.join(base, 'zlog.conf')
+    with open(zlog, 'w') as f:
+        f.write(ZLOG_CONF.format(os.path.join(base, 'zlog.log')))
+    network = os.path.join(base, os.path.basename(cfgfile))
+    with open(cfgfile, 'r') as src:
+        with open(network, 'w') as dst:
+            dst.write(src.read())
+    weightfile = os.path.join(backup, model + '.weights')
+    if not os.path.exists(weightfile):
+        gen_weights(network, weightfile)
+    vocData = os.path.join(base, 'voc.data')
+    with open(vocData, 'w') as f:
+        f.write('classes={0}\nnames={1}\nnetwork={2}\nbackup={3}\ndetect_log={4}\n'.format(
+            classes, names, network, backup, zlog))
+
+    corpus = os.path.join(work, 'corpus-{0}x{1}'.format(width, height))
+    if not os.path.isdir(corpus) or len([f for f in os.listdir(corpus) if f.endswith('.jpg')]) < images:
+        gen_corpus(corpus, images, width, height)
+    return vocData, corpus
+
+def percentiles(samples):
+    a = np.array(samples) * 1000.
+    out = {}
+    for p in (50, 95, 99):
+        out['p{0}_ms'.format(p)] = float(np.percentile(a, p))
+    out['mean_ms'] = float(a.mean())
+    return out
+
+def bench_mode(vocData, corpus, soFile, mode, warmup, batch):
+    """Runs in a fresh process: one mode over the corpus, as darknet.run() drives it."""
+    os.chdir(ROOT)    #load_alphabet reads data/labels
+    sys.path.insert(0, HERE)
+    import darknet as dk
+
+    files = sorted(os.path.join(corpus, f) for f in os.listdir(corpus)
+            if f.startswith('bench_') and f.endswith('.jpg'))
+    dn = dk.darknet(vocData, soFile=soFile, batch=batch if mode in ('p_batch', 'classify_batch') else 1)
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    latencies = []
+
+    def args_for(flags):
+        return dk.make_parser().parse_args([vocData, corpus] + flags)
+
+    try:
+        sys.stdout = devnull
+        if mode in ('i', 'e', 'c'):
+            args = args_for(['-' + mode])
+            for f in files[:warmup]:
+                dn.run(f, args)
+            t0 = time.time()
+            for f in files:
+                t = time.time()
+                dn.run(f, args)
+                latencies.append(time.time() - t)
+        elif mode == 'classify':
+            ims = [dn.load_image(f, 0, 0) for f in files]
+            for im in ims[:warmup]:
+                dn.classify(dn.net, dn.meta, im)
+            t0 = time.time()
+            for im in ims:
+                t = time.time()
+                dn.classify(dn.net, dn.meta, im)
+                latencies.append(time.time() - t)
+            for im in ims:
+                dn.free_image(im)
+        elif mode == 'classify_batch':
+            ims = [dn.load_image(f, 0, 0) for f in files]
+            dn.classify_batch(ims[:warmup])
+            t0 = time.time()
+            dn.classify_batch(ims)
+            for im in ims:
+                dn.free_image(im)
+        else:
+            flags = {'p': ['-p'],
+                     'p_pipeline': ['-p', '-P'],
+                     'p_batch': ['-p', '-b', str(batch)]}[mode]
+            for f in files[:warmup]:
+                im = dn.load_image(f, 0, 0)
+                dn.detect(im, draw=False)
+                dn.free_image(im)
+            t0 = time.time()
+            dn.run(corpus, args_for(flags))
+        elapsed = time.time() - t0
+    finally:
+        sys.stdout = stdout
+
+    out = {'images': len(files),
+           'seconds': elapsed,
+           'images_per_second': len(files) / elapsed,
+           'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    out.update(dn.memory_stats())
+    if latencies:
+        out.update(percentiles(latencies))
+    return out
+
+def bench_nms(vocData, corpus, soFile, warmup, thresh):
+    """Runs in a fresh process: NMS and decode of every image's boxes at a
+    low threshold, C against numpy on the same get_network_boxes output.
+    Results are {nms_<engine>: ...} with NMS passes per second as
+    images_per_second."""
+    os.chdir(ROOT)
+    sys.path.insert(0, HERE)
+    import darknet as dk
+    from nms import NMS
+
+    files = sorted(os.path.join(corpus, f) for f in os.listdir(corpus)
+            if f.startswith('bench_') and f.endswith('.jpg'))
+    dn = dk.darknet(vocData, soFile=soFile)
+    classes = dn.meta.classes
+    arena = dn.detections()
+    dets = arena.dets
+    latencies = dict((name, []) for name, mode, ref in NMS_ENGINES)
+    boxes = dict((name, 0) for name, mode, ref in NMS_ENGINES)
+    same = dict((name, 0) for name, mode, ref in NMS_ENGINES)
+    candidates = 0
+    for n, f in enumerate(files[:warmup] + files):
+        im = dn.load_image(f, 0, 0)
+        dn.predict_image(dn.net, im)
+        out = {}
+        for name, mode, ref in NMS_ENGINES:
+            #refilled for every engine, do_nms_* reorder the boxes
+            num = arena.fill(im.w, im.h, thresh, .5)
+            t = time.time()
+            if name == 'c':
+                dn.do_nms_obj(dets, num, classes, .45)
+                res = dn.decode_detections_array(dets, num)
+            elif name == 'c_sort':
+                dn.do_nms_sort(dets, num, classes, .45)
+                res = dn.decode_detections_array(dets, num)
+            else:
+                view = dk.detection_view(dets, num)
+                probs = dn.detection_probs(dets, num)
+                NMS(mode).suppress(view, probs, .45, thresh)
+                res = dn.results_array(view, probs)
+            elapsed = time.time() - t
+            out[name] = res.array
+            if n < warmup:
+                continue
+            latencies[name].append(elapsed)
+            boxes[name] += len(res)
+            if ref and np.array_equal(np.sort(res.array, order=['class_id', 'score', 'x', 'y']),
+                                      np.sort(out[ref], order=['class_id', 'score', 'x', 'y'])):
+                same[name] += 1
+        if n >= warmup:
+            candidates += num
+        dn.free_image(im)
+
+    results = {}
+    for name, mode, ref in NMS_ENGINES:
+        r = {'images': len(files),
+             'seconds': sum(latencies[name]),
+             'images_per_second': len(files) / max(sum(latencies[name]), 1e-9),
+             'candidates': candidates / float(len(files)),
+             'boxes': boxes[name] / float(len(files))}
+        if ref:
+            r['same_as_' + ref] = same[name] / float(len(files))
+        r.update(percentiles(latencies[name]))
+        results['nms_' + name] = r
+    return results
+
+def bench_letterbox(soFile, count, seed=0):
+    """Runs in a fresh process: the numpy letterbox of darknet.LetterboxMap
+    against the C letterbox_image, on count random frame and network sizes.
+    Results are {letterbox_c: ..., letterbox_numpy: ...}, the numpy one with
+    the share of bit-identical network inputs as same_as_c."""
+    sys.path.insert(0, HERE)
+    import darknet as dk
+
+    lib = dk.load_lib(soFile)
+    rng = np.random.RandomState(seed)
+    latencies = {'c': [], 'numpy': []}
+    same = 0
+    for i in range(count):
+        w, h = rng.randint(2, 2000), rng.randint(2, 1200)
+        net = int(rng.choice([320, 416, 608]))
+        frame = rng.randint(0, 256, size=(h, w, 3)).astype(np.uint8)
+        im = dk.frame_to_image(frame)
+        t = time.time()
+        boxed = lib.letterbox_image(im, net, net)
+        latencies['c'].append(time.time() - t)
+        ref = np.ctypeslib.as_array(boxed.data, shape=(3, net, net)).copy()
+        lib.free_image(boxed)
+        out = np.full((3, net, net), .5, dtype=np.float32)
+        m = dk.LetterboxMap(w, h, 3, net, net)
+        t = time.time()
+        m.apply(frame, out)
+        latencies['numpy'].append(time.time() - t)
+        same += np.array_equal(out, ref)
+
+    results = {}
+    for name, lat in latencies.items():
+        r = {'images': count,
+             'seconds': sum(lat),
+             'images_per_second': count / max(sum(lat), 1e-9)}
+        r.update(percentiles(lat))
+        results['letterbox_' + name] = r
+    results['letterbox_numpy']['same_as_c'] = same / float(count)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Lines describing each model/mode against the baseline, and whether any regressed."""
+    lines = []
+    regressed = False
+    for model, modes in sorted(results.items()):
+        for mode, r in sorted(modes.items()):
+            old = baseline.get(model, {}).get(mode)
+            if not old:
+                continue
+            ratio = r['images_per_second'] / old['images_per_second']
+            flag = ''
+            if ratio < 1. - tolerance:
+                flag = '  REGRESSION'
+                regressed = True
+            lines.append('{0:16s} {1:11s} {2:8.2f} -> {3:8.2f} img/s ({4:+.1%}){5}'.format(
+                model, mode, old['images_per_second'], r['images_per_second'], ratio - 1., flag))
+    return lines, regressed
+
+def git_rev():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='CPU benchmarks of the python inference paths')
+    parser.add_argument('--so', default=os.path.join(ROOT, 'libdarknet-cpu.so'), help='CPU-only libdarknet')
+    parser.add_argument('--work', default='/tmp/darknet-bench', help='workspace for weights and the corpus')
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS), help='out of ' + ', '.join(sorted(MODELS)))
+    parser.add_argument('--modes', default=','.join(MODES))
+    parser.add_argument('--images', type=int, default=20)
+    parser.add_argument('--size', default='640x480', help='corpus image WxH')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--batch', type=int, default=4, help='batch of the p_batch and classify_batch modes')
+    parser.add_argument('--nms-thresh', type=float, default=.005, help='detection threshold of the nms mode, low for dense outputs')
+    parser.add_argument('--out', default=os.path.join(ROOT, 'results', 'bench.json'))
+    parser.add_argument('--baseline', default=None, help='earlier --out to compare with')
+    parser.add_argument('--tolerance', type=float, default=.1, help='allowed img/s drop against the baseline')
+    parser.add_argument('--worker', nargs=4, metavar=('VOCDATA', 'CORPUS', 'MODE', 'BATCH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        vocData, corpus, mode, batch = args.worker
+        if mode == 'letterbox':
+            print json.dumps(bench_letterbox(os.path.abspath(args.so), args.images))
+        elif mode == 'nms':
+            print json.dumps(bench_nms(vocData, corpus, os.path.abspath(args.so), args.warmup, args.nms_thresh))
+        else:
+            print json.dumps(bench_mode(vocData, corpus, os.path.abspath(args.so), mode, args.warmup, int(batch)))
+        return 0
+
+    width, height = [int(v) for v in args.size.split('x')]
+    results = {}
+    for model in args.models.split(','):
+        vocData, corpus = prepare(os.path.abspath(args.work), model, args.images, width, height)
+        results[model] = {}
+        for mode in args.modes.split(','):
+            cmd = [sys.executable, os.path.abspath(__file__), '--so', args.so, '--warmup', str(args.warmup),
+                    '--nms-thresh', str(args.nms_thresh), '--worker', vocData, corpus, mode, str(args.batch)]
+            out = subprocess.check_output(cmd)
+            r = json.loads(out.strip().splitlines()[-1])
+            if mode == 'letterbox':
+                for name, e in sorted(r.items()):
+                    results[model][name] = e
+                    print '{0:16s} {1:11s} {2:8.2f} img/s  p50 {3:8.3f}ms{4}'.format(model, name,
+                            e['images_per_second'], e['p50_ms'],
+                            '  same_as_c {0:.0%}'.format(e['same_as_c']) if 'same_as_c' in e else '')
+                continue
+            if mode == 'nms':
+                for name, e in sorted(r.items()):
+                    results[model][name] = e
+                    print '{0:16s} {1:11s} {2:8.2f} img/s  p50 {3:8.3f}ms  {4:.0f} -> {5:.1f} boxes{6}'.format(model, name,
+                            e['images_per_second'], e['p50_ms'], e['candidates'], e['boxes'],
+                            ''.join('  {0} {1:.0%}'.format(k, v) for k, v in e.items() if k.startswith('same_as_')))
+                continue
+            results[model][mode] = r
+            print '{0:16s} {1:11s} {2:8.2f} img/s  p50 {3:>8s}ms  peak rss {4:.0f}MB'.format(model, mode,
+                    r['images_per_second'], '{0:.1f}'.format(r['p50_ms']) if 'p50_ms' in r else '-',
+                    r['peak_rss_kb'] / 1024.)
+
+    report = {'meta': {'host': socket.gethostname(),
+                       'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+                       'git': git_rev(),
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'images': args.images,
+                       'size': args.size},
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    print 'wrote {0}'.format(args.out)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        lines, regressed = compare(results, baseline, args.tolerance)
+        for line in lines:
+            print line
+        if regressed:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,19 +9,321 @@ import numpy as np
 import io
 from PIL import Image
 import time
+import threading
+import Queue
+import json
+import math
+import hashlib
+import ctypes.util
 
 logger = logging.getLogger(__name__)
 
+class timespec(Structure):
+    _fields_ = [("tv_sec", c_long),
+                ("tv_nsec", c_long)]
+
+def make_monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    librt = CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+    clock_gettime = librt.clock_gettime
+    clock_gettime.argtypes = [c_int, POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        ts = timespec()
+        clock_gettime(CLOCK_MONOTONIC, byref(ts))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = make_monotonic_clock()
+
+class MALLINFO(Structure):
+    _fields_ = [(name, c_int) for name in ('arena', 'ordblks', 'smblks', 'hblks', 'hblkhd',
+                'usmblks', 'fsmblks', 'uordblks', 'fordblks', 'keepcost')]
+
+class MALLINFO2(Structure):
+    _fields_ = [(name, c_size_t) for name, t in MALLINFO._fields_]
+
+def make_mallinfo():
+    """glibc malloc statistics, mallinfo2 where there is one; None elsewhere"""
+    try:
+        libc = CDLL(ctypes.util.find_library('c'))
+    except OSError:
+        return None
+    for name, struct in (('mallinfo2', MALLINFO2), ('mallinfo', MALLINFO)):
+        f = getattr(libc, name, None)
+        if f is not None:
+            f.argtypes = []
+            f.restype = struct
+            return f
+    return None
+
+mallinfo = make_mallinfo()
+
+def native_memory():
+    """Process memory as the C side sees it, in bytes: resident set, and the
+    malloc heap (sbrk arena, mmapped blocks and bytes in use) when known."""
+    out = {}
+    try:
+        with open('/proc/self/statm') as f:
+            out['rss_bytes'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        pass
+    if mallinfo is not None:
+        mi = mallinfo()
+        out['heap_arena_bytes'] = mi.arena
+        out['heap_mmap_bytes'] = mi.hblkhd
+        out['heap_in_use_bytes'] = mi.uordblks + mi.hblkhd
+    return out
+
+class StageTimer(object):
+    """Per-stage latency histograms.
+
+    Samples go into log-spaced buckets (BUCKETS per decade from 1us), so
+    memory stays constant over long runs and percentiles are accurate to
+    about one bucket width. Hot paths hold timer = None when timing is
+    off and skip all of this.
+    """
+    BUCKETS = 20
+    MIN = 1e-6
+
+    def __init__(self):
+        self.clock = monotonic
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, seconds):
+        b = 0
+        if seconds > self.MIN:
+            b = int(math.log10(seconds / self.MIN) * self.BUCKETS) + 1
+        with self.lock:
+            st = self.stages.get(stage)
+            if st is None:
+                st = self.stages[stage] = {'count': 0, 'sum': 0., 'max': 0., 'buckets': {}}
+            st['count'] += 1
+            st['sum'] += seconds
+            if seconds > st['max']:
+                st['max'] = seconds
+            st['buckets'][b] = st['buckets'].get(b, 0) + 1
+
+    def lap(self, stage, t0):
+        #records now - t0 and returns now, to chain stages
+        t = self.clock()
+        self.add(stage, t - t0)
+        return t
+
+    def percentile(self, stage, q):
+        st = self.stages[stage]
+        need = q / 100. * st['count']
+        seen = 0
+        for b in sorted(st['buckets']):
+            seen += st['buckets'][b]
+            if seen >= need:
+                #upper edge of the bucket, capped by the real max
+                return min(self.MIN * 10 ** (b / float(self.BUCKETS)), st['max'])
+        return st['max']
+
+    def summary(self):
+        """{stage: {count, mean_ms, p50_ms, p95_ms, p99_ms, max_ms}}"""
+        with self.lock:
+            out = {}
+            for stage, st in self.stages.items():
+                out[stage] = {'count': st['count'],
+                              'mean_ms': st['sum'] / st['count'] * 1000.,
+                              'max_ms': st['max'] * 1000.}
+                for q in (50, 95, 99):
+                    out[stage]['p{0}_ms'.format(q)] = self.percentile(stage, q) * 1000.
+            return out
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+#uint8 -> float32 lookup, bit-identical to the C side's data[i]/255.
+U8_TO_FLOAT = (np.arange(256, dtype=np.float64) / 255.).astype(np.float32)
+
 def array_to_image(arr):
     arr = arr.transpose(2,0,1)
-    c = arr.shape[0]
-    h = arr.shape[1]
-    w = arr.shape[2]
-    arr = (arr/255.0).flatten()
-    data = c_array(c_float, arr)
-    im = IMAGE(w,h,c,data)
+    if arr.dtype == np.uint8:
+        arr = np.take(U8_TO_FLOAT, arr)
+    else:
+        arr = np.ascontiguousarray(arr/255.0, dtype=np.float32)
+    return wrap_chw_array(arr)
+
+def wrap_chw_array(arr):
+    """Wrap a C-contiguous float32 CHW array as an IMAGE without copying.
+
+    The IMAGE keeps a reference to arr, never pass it to free_image.
+    """
+    if arr.ndim != 3 or arr.dtype != np.float32 or not arr.flags['C_CONTIGUOUS']:
+        raise ValueError("expected a C-contiguous float32 CHW array, got {0} {1}".format(arr.dtype, arr.shape))
+    c, h, w = arr.shape
+    im = IMAGE(w, h, c, arr.ctypes.data_as(POINTER(c_float)))
+    im.buf = arr
     return im
 
+def frame_to_image(frame, rgb=True):
+    """FrameBuffer.ingest into a fresh buffer, for images that must outlive the next frame."""
+    chw = frame.transpose(2,0,1)
+    if rgb and frame.shape[2] == 3:
+        chw = chw[::-1]
+    return wrap_chw_array(np.take(U8_TO_FLOAT, chw))
+
+class FrameBuffer():
+    """Normalized CHW float32 buffers reused per input resolution.
+
+    ingest() gives the same result as make_image + float_to_image_lrt +
+    rgbgr_image on a uint8 HWC BGR frame, without allocating per frame.
+    """
+    def __init__(self):
+        self.buffers = {}
+
+    def get(self, shape):
+        buf = self.buffers.get(shape)
+        if buf is None:
+            h, w, c = shape
+            buf = np.empty((c, h, w), dtype=np.float32)
+            self.buffers[shape] = buf
+        return buf
+
+    def ingest(self, frame, rgb=True):
+        if frame.dtype != np.uint8 or frame.ndim != 3:
+            raise ValueError("expected a uint8 HWC frame, got {0} {1}".format(frame.dtype, frame.shape))
+        buf = self.get(frame.shape)
+        chw = frame.transpose(2,0,1)
+        if rgb and frame.shape[2] == 3:
+            chw = chw[::-1]
+        np.take(U8_TO_FLOAT, chw, out=buf)
+        return wrap_chw_array(buf)
+
+def resize_axis(src, dst, vertical=False):
+    """Source index pairs and float32 weights of resize_image along one axis.
+
+    Mirrors its arithmetic: output pixel i interpolates between
+    floor(i*scale) and the next source pixel. The horizontal pass copies
+    the last input pixel to the last output one; the vertical pass has no
+    such case, its last row keeps only the (1-dy) share of row floor(sy).
+    """
+    i0 = np.full(dst, src - 1, dtype=np.intp)
+    w0 = np.ones(dst, dtype=np.float32)
+    w1 = np.zeros(dst, dtype=np.float32)
+    if vertical:
+        i0[:] = 0
+    if src > 1 and dst > 1:
+        scale = np.float32(src - 1) / np.float32(dst - 1)
+        n = dst if vertical else dst - 1
+        s = np.arange(n, dtype=np.float32) * scale
+        i0[:n] = s.astype(np.intp)
+        d = s - i0[:n].astype(np.float32)
+        w0[:n] = np.float32(1) - d
+        w1[:n] = d
+        w1[dst - 1] = 0
+    return i0, np.minimum(i0 + 1, src - 1), w0, w1
+
+class LetterboxMap(object):
+    """Cached letterbox_image geometry and interpolation maps for one
+    (input size, network size) pair.
+
+    apply() goes from a uint8 HWC BGR frame straight to the CHW float32
+    network input, doing the /255, the BGR->RGB swap and both resize passes
+    with the C operation order, so the input is bit-identical to
+    letterbox_image(frame_to_image(frame)). Only the source rows the
+    vertical pass reads are resized horizontally.
+    """
+    def __init__(self, w, h, c, net_w, net_h):
+        if np.float32(net_w) / np.float32(w) < np.float32(net_h) / np.float32(h):
+            new_w, new_h = net_w, (h * net_w) // w
+        else:
+            new_w, new_h = (w * net_h) // h, net_h
+        self.w, self.h, self.c = w, h, c
+        self.new_w, self.new_h = new_w, new_h
+        self.left, self.top = (net_w - new_w) // 2, (net_h - new_h) // 2
+        self.cols0, self.cols1, self.wx0, self.wx1 = resize_axis(w, new_w)
+        iy0, iy1, self.wy0, self.wy1 = resize_axis(h, new_h, vertical=True)
+        self.rows = np.unique(np.concatenate([iy0, iy1]))
+        self.rows0 = np.searchsorted(self.rows, iy0)
+        self.rows1 = np.searchsorted(self.rows, iy1)
+        self.wx0, self.wx1 = self.wx0[:, None], self.wx1[:, None]
+        self.wy0, self.wy1 = self.wy0[:, None, None], self.wy1[:, None, None]
+        #scratch of the two passes, HWC so the gathers read whole pixels
+        self.a = np.empty((len(self.rows), new_w, c), dtype=np.float32)
+        self.b = np.empty_like(self.a)
+        self.out = np.empty((new_h, new_w, c), dtype=np.float32)
+        self.tmp = np.empty_like(self.out)
+
+    def apply(self, frame, out, rgb=True):
+        """Letterbox frame into out, a (c, net_h, net_w) float32 array whose
+        borders already hold .5"""
+        src = frame[self.rows]
+        if rgb and self.c == 3:
+            src = src[:, :, ::-1]
+        a, b = self.a, self.b
+        np.take(U8_TO_FLOAT, src[:, self.cols0], out=a)
+        np.take(U8_TO_FLOAT, src[:, self.cols1], out=b)
+        a *= self.wx0
+        b *= self.wx1
+        a += b
+        res, tmp = self.out, self.tmp
+        np.multiply(a[self.rows0], self.wy0, out=res)
+        np.multiply(a[self.rows1], self.wy1, out=tmp)
+        res += tmp
+        out[:, self.top:self.top + self.new_h, self.left:self.left + self.new_w] = res.transpose(2, 0, 1)
+
+def tile_starts(length, tile, overlap):
+    """Offsets of equal tiles covering length, neighbours overlapping by at
+    least overlap pixels; the last tile ends at the edge."""
+    if length <= tile:
+        return [0]
+    step = max(tile - overlap, 1)
+    n = int(math.ceil(float(length - tile) / step)) + 1
+    return [int(round(v)) for v in np.linspace(0, length - tile, n)]
+
+def parse_tile(spec):
+    """(w, h) of a --tile WxH or W, None without one"""
+    if not spec:
+        return None
+    size = [int(v) for v in spec.split('x')]
+    return (size[0], size[-1])
+
+class Preprocessor(object):
+    """Fixed-resolution streams into a reused network input.
+
+    Keeps a LetterboxMap per frame shape and one (c, net_h, net_w) input
+    buffer, whose .5 borders are only refilled when the frame shape
+    changes. Boxes come out of get_network_boxes(frame w, frame h) exactly
+    as for predict_image.
+    """
+    def __init__(self, net_w, net_h):
+        self.net_w = net_w
+        self.net_h = net_h
+        self.maps = {}
+        self.input = None
+        self.shape = None
+
+    def map(self, shape):
+        m = self.maps.get(shape)
+        if m is None:
+            h, w, c = shape
+            m = self.maps[shape] = LetterboxMap(w, h, c, self.net_w, self.net_h)
+        return m
+
+    def __call__(self, frame, rgb=True):
+        if frame.dtype != np.uint8 or frame.ndim != 3:
+            raise ValueError("expected a uint8 HWC frame, got {0} {1}".format(frame.dtype, frame.shape))
+        m = self.map(frame.shape)
+        if self.input is None or self.input.shape[0] != m.c:
+            self.input = np.empty((m.c, self.net_h, self.net_w), dtype=np.float32)
+            self.shape = None
+        if self.shape != frame.shape:
+            self.input.fill(.5)
+            self.shape = frame.shape
+        m.apply(frame, self.input, rgb)
+        return self.input
+
 def sample(probs):
     s = sum(probs)
     probs = [a/s for a in probs]
@@ -62,170 +364,529 @@ class METADATA(Structure):
     _fields_ = [("classes", c_int),
                 ("names", POINTER(c_char_p))]
 
-    
-class darknet():
-    def __init__(self, vocData, soFile='../libdarknet.so', input_width=None, input_height=None, input_channel=None):
-        self.lib = CDLL(soFile, RTLD_GLOBAL)
-
-        self.lib.network_width.argtypes = [c_void_p]
-        self.lib.network_width.restype = c_int
-        self.lib.network_height.argtypes = [c_void_p]
-        self.lib.network_height.restype = c_int
-
-        self.predict = self.lib.network_predict
-        self.predict.argtypes = [c_void_p, POINTER(c_float)]
-        self.predict.restype = POINTER(c_float)
-
-        self.set_gpu = self.lib.cuda_set_device
-        self.set_gpu.argtypes = [c_int]
-
-        self.make_image = self.lib.make_image
-        self.make_image.argtypes = [c_int, c_int, c_int]
-        self.make_image.restype = IMAGE
-
-        self.get_network_boxes = self.lib.get_network_boxes
-        self.get_network_boxes.argtypes = [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(c_int)]
-        self.get_network_boxes.restype = POINTER(DETECTION)
-
-        self.make_network_boxes = self.lib.make_network_boxes
-        self.make_network_boxes.argtypes = [c_void_p]
-        self.make_network_boxes.restype = POINTER(DETECTION)
-
-        self.free_detections = self.lib.free_detections
-        self.free_detections.argtypes = [POINTER(DETECTION), c_int]
-
-        self.free_ptrs = self.lib.free_ptrs
-        self.free_ptrs.argtypes = [POINTER(c_void_p), c_int]
-
-        self.network_predict = self.lib.network_predict
-        self.network_predict.argtypes = [c_void_p, POINTER(c_float)]
-
-        self.reset_rnn = self.lib.reset_rnn
-        self.reset_rnn.argtypes = [c_void_p]
-
-        self.load_net = self.lib.load_network
-        self.load_net.argtypes = [c_char_p, c_char_p, c_int]
-        self.load_net.restype = c_void_p
-
-        self.do_nms_obj = self.lib.do_nms_obj
-        self.do_nms_obj.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
-
-        self.do_nms_sort = self.lib.do_nms_sort
-        self.do_nms_sort.argtypes = [POINTER(DETECTION), c_int, c_int, c_float]
-
-        self.free_image = self.lib.free_image
-        self.free_image.argtypes = [IMAGE]
-
-        self.save_image = self.lib.save_image
-        self.save_image.argtypes = [IMAGE, c_char_p]
-
-        self.letterbox_image = self.lib.letterbox_image
-        self.letterbox_image.argtypes = [IMAGE, c_int, c_int]
-        self.letterbox_image.restype = IMAGE
-
-        self.load_meta = self.lib.get_metadata
-        self.lib.get_metadata.argtypes = [c_char_p]
-        self.lib.get_metadata.restype = METADATA
-
-        self.load_image = self.lib.load_image_color
-        self.load_image.argtypes = [c_char_p, c_int, c_int]
-        self.load_image.restype = IMAGE
-
-        self.rgbgr_image = self.lib.rgbgr_image
-        self.rgbgr_image.argtypes = [IMAGE]
-
-        self.predict_image = self.lib.network_predict_image
-        self.predict_image.argtypes = [c_void_p, IMAGE]
-        self.predict_image.restype = POINTER(c_float)
-
-
-        #lrt
-        self.free_float = self.lib.free_float
-        self.free_float.argtypes = [POINTER(c_float)]
-
-        self.what_time_is_it_now = self.lib.what_time_is_it_now
-        self.what_time_is_it_now.restype = c_double
-
-        self.float_to_image_lrt = self.lib.float_to_image_lrt
-        self.float_to_image_lrt.argtrypes = [c_int,c_int,c_int,c_int,POINTER(c_char_p),POINTER(IMAGE)]
+#numpy view of the float fields of a DETECTION array
+DETECTION_DTYPE = np.dtype({
+    'names': ['x', 'y', 'w', 'h', 'objectness'],
+    'formats': [np.float32] * 5,
+    'offsets': [DETECTION.bbox.offset + BOX.x.offset,
+                DETECTION.bbox.offset + BOX.y.offset,
+                DETECTION.bbox.offset + BOX.w.offset,
+                DETECTION.bbox.offset + BOX.h.offset,
+                DETECTION.objectness.offset],
+    'itemsize': sizeof(DETECTION)})
+
+RESULT_DTYPE = np.dtype([('class_id', np.int32),
+                         ('score', np.float32),
+                         ('x', np.float32),
+                         ('y', np.float32),
+                         ('w', np.float32),
+                         ('h', np.float32)])
+
+def detection_view(dets, num):
+    if num == 0:
+        return np.zeros(0, dtype=DETECTION_DTYPE)
+    raw = np.ctypeslib.as_array(cast(dets, POINTER(c_ubyte)), shape=(num * sizeof(DETECTION),))
+    return raw.view(DETECTION_DTYPE)
+
+class Detections(object):
+    """Detections as a RESULT_DTYPE structured array, sorted by score.
+
+    Iterating or indexing gives the (name, score, (x, y, w, h)) tuples
+    detect() returns; they are built on first use only.
+    """
+    def __init__(self, array, names):
+        self.array = array
+        self.names = names
+        self._list = None
+
+    def tolist(self):
+        if self._list is None:
+            self._list = [(self.names[r['class_id']], float(r['score']),
+                (float(r['x']), float(r['y']), float(r['w']), float(r['h']))) for r in self.array]
+        return self._list
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, i):
+        return self.tolist()[i]
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+class TopK(object):
+    """The best classes of one image, as class ids and scores, best first.
+
+    Iterating or indexing gives the (name, score) pairs classify() returns;
+    names come from a label array and only when asked for.
+    """
+    def __init__(self, class_ids, scores, labels):
+        self.class_ids = class_ids
+        self.scores = scores
+        self.labels = labels
+        self._list = None
+
+    def tolist(self):
+        if self._list is None:
+            self._list = zip(self.labels[self.class_ids].tolist(), self.scores.tolist())
+        return self._list
+
+    def __len__(self):
+        return len(self.class_ids)
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, i):
+        return self.tolist()[i]
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+def top_k(scores, k):
+    """(ids, scores) of the k best of each row of scores, best first and
+    equal scores in class order; a tie at the k-th place is cut arbitrarily"""
+    n = scores.shape[1]
+    if k < n:
+        ids = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        ids = np.tile(np.arange(n), (len(scores), 1))
+    rows = np.arange(len(scores))[:, None]
+    best = scores[rows, ids]
+    order = np.lexsort((ids, -best), axis=1)
+    return ids[rows, order], best[rows, order]
+
+class DetectionArena(object):
+    """One network's DETECTION buffers, allocated once and refilled in place.
+
+    make_network_boxes with a threshold of -1 sizes the array for every box
+    the output layers can give, so fill() and fill_batch() never allocate:
+    they return how many leading entries the last forward pass filled.
+    Those stay valid until the next fill; do_nms_* may reorder them.
+    """
+    def __init__(self, lib, net, classes):
+        self.lib = lib
+        self.net = net
+        n = c_int(0)
+        self.dets = lib.make_network_boxes(net, -1., byref(n))
+        self.capacity = n.value
+        #the DETECTION structs and their prob arrays
+        self.nbytes = self.capacity * (sizeof(DETECTION) + classes * sizeof(c_float))
+        self.fills = 0
+
+    def fill(self, w, h, thresh, hier_thresh, relative=0):
+        num = self.lib.num_detections(self.net, thresh)
+        self.lib.fill_network_boxes(self.net, w, h, thresh, hier_thresh, None, relative, self.dets)
+        self.fills += 1
+        return num
+
+    def fill_batch(self, b, w, h, thresh, hier_thresh, relative=0):
+        self.fills += 1
+        return self.lib.fill_network_boxes_batch(self.net, b, w, h, thresh, hier_thresh, None, relative, self.dets)
+
+    def close(self):
+        if self.dets:
+            self.lib.free_detections(self.dets, self.capacity)
+            self.dets = None
+
+#(attribute, C symbol, argtypes, restype); None leaves the ctypes default.
+#One entry per C symbol: entries for the same symbol share one ctypes
+#function and the last argtypes/restype would win for all of them
+BINDINGS = [
+    ('network_width', 'network_width', [c_void_p], c_int),
+    ('network_height', 'network_height', [c_void_p], c_int),
+    ('network_outputs', 'network_outputs', [c_void_p], c_int),
+    ('predict', 'network_predict', [c_void_p, POINTER(c_float)], POINTER(c_float)),
+    ('set_gpu', 'cuda_set_device', [c_int], None),
+    ('make_image', 'make_image', [c_int, c_int, c_int], IMAGE),
+    ('get_network_boxes', 'get_network_boxes', [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(c_int)], POINTER(DETECTION)),
+    ('set_batch_network', 'set_batch_network', [c_void_p, c_int], None),
+    ('make_network_boxes', 'make_network_boxes', [c_void_p, c_float, POINTER(c_int)], POINTER(DETECTION)),
+    ('num_detections', 'num_detections', [c_void_p, c_float], c_int),
+    ('fill_network_boxes', 'fill_network_boxes', [c_void_p, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(DETECTION)], None),
+    ('fill_network_boxes_batch', 'fill_network_boxes_batch', [c_void_p, c_int, c_int, c_int, c_float, c_float, POINTER(c_int), c_int, POINTER(DETECTION)], c_int),
+    ('free_detections', 'free_detections', [POINTER(DETECTION), c_int], None),
+    ('get_detection_probs', 'get_detection_probs', [POINTER(DETECTION), c_int, c_int, POINTER(c_float)], None),
+    ('free_ptrs', 'free_ptrs', [POINTER(c_void_p), c_int], None),
+    ('reset_rnn', 'reset_rnn', [c_void_p], None),
+    ('reset_network_state', 'reset_network_state', [c_void_p, c_int], None),
+    ('reorder_network_state', 'reorder_network_state', [c_void_p, POINTER(c_int), c_int], None),
+    ('network_inputs', 'network_inputs', [c_void_p], c_int),
+    ('load_net', 'load_network', [c_char_p, c_char_p, c_int], c_void_p),
+    ('do_nms_obj', 'do_nms_obj', [POINTER(DETECTION), c_int, c_int, c_float], None),
+    ('do_nms_sort', 'do_nms_sort', [POINTER(DETECTION), c_int, c_int, c_float], None),
+    ('free_image', 'free_image', [IMAGE], None),
+    ('save_image', 'save_image', [IMAGE, c_char_p], None),
+    ('letterbox_image', 'letterbox_image', [IMAGE, c_int, c_int], IMAGE),
+    ('letterbox_image_into', 'letterbox_image_into', [IMAGE, c_int, c_int, IMAGE], None),
+    ('load_meta', 'get_metadata', [c_char_p], METADATA),
+    ('load_image', 'load_image_color', [c_char_p, c_int, c_int], IMAGE),
+    ('rgbgr_image', 'rgbgr_image', [IMAGE], None),
+    ('predict_image', 'network_predict_image', [c_void_p, IMAGE], POINTER(c_float)),
+    #lrt
+    ('free_float', 'free_float', [POINTER(c_float)], None),
+    ('what_time_is_it_now', 'what_time_is_it_now', None, c_double),
+    ('float_to_image_lrt', 'float_to_image_lrt', [c_int, POINTER(c_char_p), IMAGE], None),
+    ('image_to_float_lrt', 'image_to_float_lrt', [IMAGE, POINTER(c_char_p)], None),
+    ('draw_detections', 'draw_detections', [IMAGE, POINTER(DETECTION), c_int, c_float, POINTER(c_char_p), POINTER(POINTER(IMAGE)), c_int], None),
+    ('draw_box_width', 'draw_box_width', [IMAGE, c_int, c_int, c_int, c_int, c_int, c_float, c_float, c_float], None),
+    ('get_label', 'get_label', [POINTER(POINTER(IMAGE)), c_char_p, c_int], IMAGE),
+    ('draw_label', 'draw_label', [IMAGE, c_int, c_int, IMAGE, POINTER(c_float)], None),
+    ('get_color', 'get_color', [c_int, c_int, c_int], c_float),
+]
+
+LIBS = {}
+LIBS_LOCK = threading.Lock()
+
+def load_lib(soFile):
+    """CDLL for soFile with BINDINGS applied, shared by every instance."""
+    with LIBS_LOCK:
+        lib = LIBS.get(soFile)
+        if lib is None:
+            lib = CDLL(soFile, RTLD_GLOBAL)
+            for name, cname, argtypes, restype in BINDINGS:
+                f = getattr(lib, cname)
+                if argtypes is not None:
+                    f.argtypes = argtypes
+                if restype is not None:
+                    f.restype = restype
+            lib.load_alphabet.restype = POINTER(POINTER(IMAGE))
+            LIBS[soFile] = lib
+    return lib
+
+def read_data_cfg(datacfg):
+    options = dict()
+    options['gpus'] = ''
+    options['num_workers'] = '10'
+    with open(datacfg, 'r') as fp:
+        lines = fp.readlines()
+
+    for line in lines:
+        line = line.strip()
+        if line == '':
+            continue
+        key,value = line.split('=')
+        key = key.strip()
+        value = value.strip()
+        options[key] = value
+    return options
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def utf8_strings(obj):
+    #json gives unicode, ctypes and the rest of this file want str
+    if isinstance(obj, dict):
+        return dict((utf8_strings(k), utf8_strings(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [utf8_strings(v) for v in obj]
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    return obj
+
+def write_atomic(path, data):
+    #several workers may start at once, never let one read a half written file
+    tmp = "{0}.{1}.tmp".format(path, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+class Manifest(object):
+    """Startup facts for one voc.data, cached in <voc.data>.manifest.
+
+    Holds the parsed data options, the weights picked from the backup
+    directory and the prepared detect cfg with content hashes. Each entry
+    is rebuilt only when its source changed: voc.data by mtime and size,
+    the weights by the name, times and size of every candidate in the
+    backup directory, the cfg by the hash of the source cfg and of the
+    prepared file.
+    """
+    def __init__(self, vocData):
+        self.vocData = vocData
+        self.path = vocData + '.manifest'
+        self.dirty = False
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = utf8_strings(json.load(f))
+            except ValueError:
+                logger.warning("Ignore broken manifest:{0}".format(self.path))
+
+    def stamp(self, path):
+        st = os.stat(path)
+        return [st.st_mtime, st.st_size]
+
+    def data_options(self):
+        stamp = self.stamp(self.vocData)
+        entry = self.entries.get('data')
+        if entry is None or entry['stamp'] != stamp:
+            entry = {'stamp': stamp, 'options': read_data_cfg(self.vocData)}
+            self.entries['data'] = entry
+            self.dirty = True
+        return entry['options']
+
+    def weights(self, backup):
+        #every candidate's stat, not the directory's: training rewrites
+        #*_last.weights in place, which leaves the directory mtime alone
+        stamp = []
+        for w in sorted(os.listdir(backup)):
+            if w.endswith('.weights'):
+                st = os.stat(os.path.join(backup, w))
+                stamp.append([w, st.st_mtime, st.st_ctime, st.st_size])
+        entry = self.entries.get('weights')
+        if entry is None or entry['backup'] != backup or entry['stamp'] != stamp:
+            #newest ctime, name breaks ties so the pick is deterministic
+            newest = max(stamp, key=lambda x: (x[2], x[0])) if stamp else None
+            entry = {'backup': backup, 'stamp': stamp,
+                     'file': os.path.join(backup, newest[0]) if newest else None}
+            self.entries['weights'] = entry
+            self.dirty = True
+        return entry['file']
+
+    def detect_cfg(self, network, batch):
+        tmp_cfg_name = os.path.split(network)
+        if batch == 1:
+            detect_cfg_file = os.path.join(tmp_cfg_name[0], "detect-{0}".format(tmp_cfg_name[1]))
+        else:
+            detect_cfg_file = os.path.join(tmp_cfg_name[0], "detect-b{0}-{1}".format(batch, tmp_cfg_name[1]))
+
+        source_hash = file_hash(network)
+        key = 'cfg-{0}'.format(batch)
+        entry = self.entries.get(key)
+        if (entry is not None and entry['source'] == network and entry['source_hash'] == source_hash
+                and entry['file'] == detect_cfg_file and os.path.exists(detect_cfg_file)
+                and file_hash(detect_cfg_file) == entry['hash']):
+            return detect_cfg_file
+
+        out = []
+        with open(network,'r') as f:
+            for a in f.readlines():
+                b = a.split('=')
+                if b[0].lower() == 'batch':
+                    a= 'batch={0}\n'.format(batch)
+                elif b[0].lower() == 'subdivisions':
+                    a= 'subdivisions=1\n'
+                out.append(a)
+        data = ''.join(out)
+        write_atomic(detect_cfg_file, data)
+        logger.debug("Prepared cfg network file:{0}".format(detect_cfg_file))
+        self.entries[key] = {'source': network, 'source_hash': source_hash,
+                'file': detect_cfg_file, 'hash': hashlib.sha1(data).hexdigest()}
+        self.dirty = True
+        return detect_cfg_file
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            write_atomic(self.path, json.dumps(self.entries, indent=1, sort_keys=True))
+            self.dirty = False
+        except (IOError, OSError) as e:
+            logger.warning("Cannot write manifest {0}:{1}".format(self.path, e))
+
+ALPHABET = None
+ALPHABET_LOCK = threading.Lock()
+
+def load_alphabet_once(lib):
+    """The data/labels glyph atlas, loaded once per process and never freed."""
+    global ALPHABET
+    with ALPHABET_LOCK:
+        if ALPHABET is None:
+            ALPHABET = lib.load_alphabet()
+    return ALPHABET
+
+class Renderer(object):
+    """Draws decoded detect() results onto IMAGEs, after inference.
+
+    draw() works inline. With workers > 0, submit() hands the image to
+    background threads instead and callback(im, res) runs once it is
+    drawn, e.g. to save and free it. The caller must not touch a
+    submitted image until its callback has run. Drawing a submitted image
+    counts as the 'draw' stage of timer, inline or not.
+    """
+    def __init__(self, lib, names, use_alphabet=1, thresh=.5, workers=0, maxsize=16, timer=None):
+        self.lib = lib
+        self.names = names
+        self.timer = timer
+        self.class_ids = dict((n, i) for i, n in enumerate(names))
+        self.thresh = thresh
+        self.alphabet = load_alphabet_once(lib) if use_alphabet else None
+
+        self.draw_box_width = lib.draw_box_width
+        self.get_label = lib.get_label
+        self.draw_label = lib.draw_label
+        self.get_color = lib.get_color
+        self.free_image = lib.free_image
+
+        self.queue = Queue.Queue(maxsize)
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self.work, name="render-{0}".format(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def draw(self, im, res):
+        names = self.names
+        classes = len(names)
+        #one box per location, labels of all its classes joined like draw_detections
+        boxes = []
+        labels = {}
+        for name, prob, b in res:
+            if prob <= self.thresh:
+                continue
+            if b not in labels:
+                boxes.append(b)
+                labels[b] = []
+            labels[b].append(self.class_ids[name])
+
+        width = int(im.h * .006)
+        for b in boxes:
+            ids = sorted(labels[b])
+            offset = ids[0]*123457 % classes
+            red = self.get_color(2, offset, classes)
+            green = self.get_color(1, offset, classes)
+            blue = self.get_color(0, offset, classes)
+
+            x, y, w, h = b
+            left = max(int(x - w/2.), 0)
+            right = min(int(x + w/2.), im.w - 1)
+            top = max(int(y - h/2.), 0)
+            bot = min(int(y + h/2.), im.h - 1)
+
+            self.draw_box_width(im, left, top, right, bot, width, red, green, blue)
+            if self.alphabet:
+                label = self.get_label(self.alphabet, ", ".join(names[i] for i in ids), int(im.h*.03))
+                self.draw_label(im, top + width, left, label, (c_float*3)(red, green, blue))
+                self.free_image(label)
+
+    def timed_draw(self, im, res):
+        timer = self.timer
+        if timer: t = timer.clock()
+        self.draw(im, res)
+        if timer: timer.lap('draw', t)
+
+    def submit(self, im, res, callback=None):
+        if not self.threads:
+            self.timed_draw(im, res)
+            if callback: callback(im, res)
+            return
+        self.queue.put((im, res, callback))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                im, res, callback = item
+                self.timed_draw(im, res)
+                if callback: callback(im, res)
+            except Exception:
+                logger.exception("render failed")
+            finally:
+                self.queue.task_done()
+
+    def close(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
 
-        self.image_to_float_lrt = self.lib.image_to_float_lrt
-        self.image_to_float_lrt.argtypes = [IMAGE,POINTER(c_char_p)]
-        #self.image_to_float_lrt.restype = POINTER(c_float)
 
-        self.load_alphabet = self.lib.load_alphabet
-        self.load_alphabet.restype = POINTER(POINTER(IMAGE))
+class darknet():
+    def __init__(self, vocData, soFile='../libdarknet.so', input_width=None, input_height=None, input_channel=None, batch=1, weightfile=None, timing=False, nms_engine=None):
+        self.lib = load_lib(soFile)
+        for name, cname, argtypes, restype in BINDINGS:
+            setattr(self, name, getattr(self.lib, cname))
 
-        self.draw_detections = self.lib.draw_detections
-        self.draw_detections.argtypes = [IMAGE,POINTER(DETECTION),c_int,
-                c_float,POINTER(c_char_p), POINTER(POINTER(IMAGE)), c_int]
+        self.load_alphabet = lambda: load_alphabet_once(self.lib)
 
+        self.renderers = {}
 
-        data_options = self.read_data_cfg(vocData)
+        manifest = Manifest(vocData)
+        data_options = manifest.data_options()
+        self.data_options = data_options
         self.lib.log_init(data_options["detect_log"])
 
         #-------------------------------------------
         #in your project the log file change yourself
-        weights = os.listdir(data_options["backup"])
-        t1 = 0
-        weightfile = None
-        for w in weights:
-            if not w.endswith('.weights'):
-                continue
-            f = os.path.join(data_options["backup"],w)
-            t = os.path.getctime(f)
-            if t > t1:
-                t1 = t
-                weightfile = f
-
-        tmp_cfg_name = os.path.split(data_options["network"])
-        detect_cfg_file = os.path.join(tmp_cfg_name[0], "detect-{0}".format(tmp_cfg_name[1]))
-        if not os.path.exists(detect_cfg_file):
-            nf = open(detect_cfg_file,'w')
-            with open(data_options["network"],'r') as f:
-                tmp = f.readlines()
-
-                for a in tmp:
-                    b = a.split('=')
-                    if b == 0 :
-                        continue
-                    if b[0].lower() == 'batch':
-                        a= 'batch=1\n'
-                    elif b[0].lower() == 'subdivisions':
-                        a= 'subdivisions=1\n'
-                    nf.write(a)
-            nf.close()
-
+        if weightfile is None:
+            weightfile = manifest.weights(data_options["backup"])
+        detect_cfg_file = manifest.detect_cfg(data_options["network"], batch)
+        manifest.save()
 
         logger.debug("Load cfg network file:{0}".format(detect_cfg_file))
         logger.debug("Load weight file:{0}".format(weightfile))
 
         self.net = self.load_net(detect_cfg_file, weightfile, 0)
         self.meta = self.load_meta(vocData)
+        self.names = [self.meta.names[i] for i in range(self.meta.classes)]
+        self.probs = np.zeros((0, self.meta.classes), dtype=np.float32)
+        self.batch = batch
+        self.net_width = self.network_width(self.net)
+        self.net_height = self.network_height(self.net)
+        self.batch_input = None
+        #None for the C do_nms_obj, else an nms.NMS
+        self.nms_engine = nms_engine
 
         self.input_height = input_height
         self.input_width = input_width
         self.input_channel = input_channel
         self.dtype_itemsize = 1
+        self.frames = FrameBuffer()
+        self.preprocess = Preprocessor(self.net_width, self.net_height)
+        #made on the first detection, classifiers never need one
+        self.arena = None
+        #the names as an array for classify_batch, made on first use
+        self.labels = None
         #lrt end
 
+        self.timer = None
+        self.enable_timing(timing)
+
+    def enable_timing(self, on=True):
+        """Per-stage timings in self.timer; off, the hot path only tests for None."""
+        if on:
+            self.timer = self.timer or StageTimer()
+        else:
+            self.timer = None
+        for renderer in self.renderers.values():
+            renderer.timer = self.timer
+
+
+    def detections(self):
+        """The network's DetectionArena"""
+        if self.arena is None:
+            self.arena = DetectionArena(self.lib, self.net, self.meta.classes)
+        return self.arena
+
+    def close(self):
+        """Free the detection arena; the next detection makes a new one"""
+        if self.arena is not None:
+            self.arena.close()
+            self.arena = None
+
+    def __del__(self):
+        self.close()
+
+    def memory_stats(self):
+        """native_memory() plus the detection arena's size and use"""
+        out = native_memory()
+        if self.arena is not None:
+            out['arena_capacity'] = self.arena.capacity
+            out['arena_bytes'] = self.arena.nbytes
+            out['arena_fills'] = self.arena.fills
+        return out
 
     def read_data_cfg(self, datacfg):
-        options = dict()
-        options['gpus'] = ''
-        options['num_workers'] = '10'
-        with open(datacfg, 'r') as fp:
-            lines = fp.readlines()
-
-        for line in lines:
-            line = line.strip()
-            if line == '':
-                continue
-            key,value = line.split('=')
-            key = key.strip()
-            value = value.strip()
-            options[key] = value
-        return options
+        return read_data_cfg(datacfg)
 
 
     def classify(self, net, meta, im):
@@ -236,83 +897,366 @@ class darknet():
         res = sorted(res, key=lambda x: -x[1])
         return res
 
-    def detect(self, im, thresh=.5, hier_thresh=.5, nms=.45, use_alphabet=1):
-        res = []
-        num = c_int(0)
-        pnum = pointer(num)
+    def classify_batch(self, images, k=5):
+        """classify() on a list of IMAGEs, cut to the k best classes.
+
+        Images are letterboxed as predict_image does, self.batch per
+        forward pass. The outputs are read in place from the network and
+        only the top k of each image is selected and sorted, so a 21k class
+        network costs no more per image than a small one. Returns one TopK
+        per image.
+        """
+        if self.labels is None:
+            self.labels = np.array(self.names, dtype=object)
+        outputs = self.network_outputs(self.net)
+        classes = min(self.meta.classes, outputs)
+        k = min(k, classes)
+        results = []
+        timer = self.timer
+        for start in range(0, len(images), self.batch):
+            group = images[start:start + self.batch]
+            n = len(group)
+            if self.batch_input is None or self.batch_input.shape[1] != group[0].c:
+                self.batch_input = np.empty((self.batch, group[0].c, self.net_height, self.net_width), dtype=np.float32)
+            if timer: t = timer.clock()
+            X = self.batch_input
+            X[:n].fill(.5)
+            for i, im in enumerate(group):
+                self.letterbox_image_into(im, self.net_width, self.net_height, wrap_chw_array(X[i]))
+            if timer: t = timer.lap('letterbox', t)
+
+            self.set_batch_network(self.net, n)
+            out = self.predict(self.net, X.ctypes.data_as(POINTER(c_float)))
+            if timer: t = timer.lap('predict_batch', t)
+            #a view of the network's output buffer, good until the next forward pass
+            scores = np.ctypeslib.as_array(out, shape=(n, outputs))[:, :classes]
+            ids, best = top_k(scores, k)
+            results.extend(TopK(ids[i], best[i], self.labels) for i in range(n))
+            if timer: t = timer.lap('top_k', t)
+        return results
+
+    def detection_probs(self, dets, num):
+        """(num, classes) probs of dets, in a buffer reused by the next call"""
+        if self.probs.shape[0] < num:
+            self.probs = np.empty((num, self.meta.classes), dtype=np.float32)
+        probs = self.probs[:num]
+        if num:
+            self.get_detection_probs(dets, num, self.meta.classes, probs.ctypes.data_as(POINTER(c_float)))
+        return probs
+
+    def results_array(self, view, probs):
+        det_ids, class_ids = np.nonzero(probs > 0)
+        scores = probs[det_ids, class_ids]
+        #stable, so ties keep the detection x class order of decode_detections
+        order = np.argsort(-scores, kind='mergesort')
+        det_ids = det_ids[order]
+        res = np.empty(len(order), dtype=RESULT_DTYPE)
+        res['class_id'] = class_ids[order]
+        res['score'] = scores[order]
+        for k in ('x', 'y', 'w', 'h'):
+            res[k] = view[k][det_ids]
+        return Detections(res, self.names)
+
+    def decode_detections_array(self, dets, num):
+        return self.results_array(detection_view(dets, num), self.detection_probs(dets, num))
+
+    def renderer(self, use_alphabet=1, thresh=.5, workers=0):
+        """Renderer for this network's classes; inline ones are shared."""
+        if workers:
+            return Renderer(self.lib, self.names, use_alphabet, thresh, workers, timer=self.timer)
+        key = (bool(use_alphabet), thresh)
+        if key not in self.renderers:
+            self.renderers[key] = Renderer(self.lib, self.names, use_alphabet, thresh, timer=self.timer)
+        return self.renderers[key]
+
+    def detect(self, im, thresh=.5, hier_thresh=.5, nms=.45, use_alphabet=1, as_array=False, draw=True):
+        timer = self.timer
+        if timer: t = timer.clock()
 
         self.predict_image(self.net, im)
-        dets = self.get_network_boxes(self.net, im.w, im.h, thresh, hier_thresh, None, 0, pnum)
-        num = pnum[0]
-        if (nms): self.do_nms_obj(dets, num, self.meta.classes, nms);
-
-        image_alphabet = None
-        if use_alphabet:
-            #TODO
-            """TODO:It'll out of memory if use self.load_alphabet"""
-            image_alphabet = self.load_alphabet()
+        if timer: t = timer.lap('predict_image', t)
+        res = self.network_results(im.w, im.h, thresh, hier_thresh, nms, as_array)
+
+        #draw=False for headless runs, or draw later with self.renderer(...)
+        if draw:
+            if timer: t = timer.clock()
+            self.renderer(use_alphabet, thresh).draw(im, res)
+            if timer: t = timer.lap('draw', t)
+        return res
 
-        self.draw_detections(im, dets, num, thresh, 
-                self.meta.names,
-                image_alphabet, 
-                self.meta.classes);
+    def detect_frame(self, frame, thresh=.5, hier_thresh=.5, nms=.45, as_array=False, rgb=True):
+        """detect() on a uint8 HWC BGR frame, letterboxed by self.preprocess
+        into its reused input; nothing is drawn."""
+        timer = self.timer
+        if timer: t = timer.clock()
+        X = self.preprocess(frame, rgb)
+        if timer: t = timer.lap('preprocess', t)
+        self.set_batch_network(self.net, 1)
+        self.predict(self.net, X.ctypes.data_as(POINTER(c_float)))
+        if timer: t = timer.lap('predict', t)
+        return self.network_results(frame.shape[1], frame.shape[0], thresh, hier_thresh, nms, as_array)
+
+    def network_results(self, w, h, thresh, hier_thresh, nms, as_array):
+        """Boxes of the last single image forward pass, for a w x h image"""
+        timer = self.timer
+        if timer: t = timer.clock()
+        arena = self.detections()
+        dets = arena.dets
+        num = arena.fill(w, h, thresh, hier_thresh)
+        if timer: t = timer.lap('get_network_boxes', t)
+        engine = self.nms_engine if nms else None
+        if engine:
+            view = detection_view(dets, num)
+            probs = self.detection_probs(dets, num)
+            engine.suppress(view, probs, nms, thresh)
+            if timer: t = timer.lap('nms', t)
+            res = self.results_array(view, probs)
+            if not as_array:
+                res = res.tolist()
+        else:
+            if (nms): self.do_nms_obj(dets, num, self.meta.classes, nms);
+            if timer: t = timer.lap('do_nms_obj', t)
+
+            if as_array:
+                res = self.decode_detections_array(dets, num)
+            else:
+                res = self.decode_detections(dets, num)
+
+        if timer: t = timer.lap('decode', t)
+        return res
 
+    def decode_detections(self, dets, num):
+        res = []
         for j in range(num):
-            classe = -1
             for i in range(self.meta.classes):
                 if dets[j].prob[i] > 0:
                     b = dets[j].bbox
                     res.append((self.meta.names[i], dets[j].prob[i], (b.x, b.y, b.w, b.h)))
         res = sorted(res, key=lambda x: -x[1])
-
-        self.free_detections(dets, num)
         return res
 
+    def detect_tiled(self, frame, tile=None, overlap=.2, thresh=.5, hier_thresh=.5, nms=.45, as_array=False, rgb=True):
+        """detect_frame() on a large uint8 HWC BGR frame, in tiles.
+
+        Tiles are tile=(w, h) pixels, the network size by default, and
+        overlap by that fraction of a tile. They go through the network
+        self.batch at a time, letterboxed from views of the frame, so
+        memory scales with the batch, not the frame. Boxes are moved to
+        frame coordinates and one NMS pass over all tiles, self.nms_engine
+        or the numpy twin of do_nms_obj, merges the duplicates along the
+        seams. Nothing is drawn.
+        """
+        from nms import NMS
+        if frame.dtype != np.uint8 or frame.ndim != 3:
+            raise ValueError("expected a uint8 HWC frame, got {0} {1}".format(frame.dtype, frame.shape))
+        H, W, c = frame.shape
+        tw, th = tile or (self.net_width, self.net_height)
+        tw, th = min(tw, W), min(th, H)
+        tiles = [(x, y) for y in tile_starts(H, th, int(overlap * th))
+                        for x in tile_starts(W, tw, int(overlap * tw))]
+        m = self.preprocess.map((th, tw, c))
+        timer = self.timer
+        if self.batch_input is None or self.batch_input.shape[1] != c:
+            self.batch_input = np.empty((self.batch, c, self.net_height, self.net_width), dtype=np.float32)
+        X = self.batch_input
+
+        views, probs = [], []
+        arena = self.detections()
+        dets = arena.dets
+        for start in range(0, len(tiles), self.batch):
+            group = tiles[start:start + self.batch]
+            n = len(group)
+            if timer: t = timer.clock()
+            X[:n].fill(.5)
+            for i, (x, y) in enumerate(group):
+                m.apply(frame[y:y + th, x:x + tw], X[i], rgb)
+            if timer: t = timer.lap('preprocess', t)
+            self.set_batch_network(self.net, n)
+            self.predict(self.net, X.ctypes.data_as(POINTER(c_float)))
+            if timer: t = timer.lap('predict_batch', t)
+            for i, (x, y) in enumerate(group):
+                num = arena.fill_batch(i, tw, th, thresh, hier_thresh)
+                view = detection_view(dets, num).copy()
+                view['x'] += x
+                view['y'] += y
+                views.append(view)
+                probs.append(self.detection_probs(dets, num).copy())
+            if timer: t = timer.lap('get_network_boxes', t)
+
+        if timer: t = timer.clock()
+        view = np.concatenate(views)
+        probs = np.concatenate(probs)
+        if nms:
+            (self.nms_engine or NMS('obj')).suppress(view, probs, nms, thresh)
+            if timer: t = timer.lap('nms', t)
+        res = self.results_array(view, probs)
+        if timer: t = timer.lap('decode', t)
+        return res if as_array else res.tolist()
+
+    def detect_batch(self, images, thresh=.5, hier_thresh=.5, nms=.45, use_alphabet=1, as_array=False, draw=True):
+        """Detect on a list of IMAGEs, self.batch images per forward pass.
+
+        Returns one result list per image, in the same format as detect().
+        The network must have been loaded with batch > 1 to gain anything.
+        """
+        results = []
+        timer = self.timer
+        for start in range(0, len(images), self.batch):
+            group = images[start:start + self.batch]
+            n = len(group)
+            if self.batch_input is None or self.batch_input.shape[1] != group[0].c:
+                self.batch_input = np.empty((self.batch, group[0].c, self.net_height, self.net_width), dtype=np.float32)
+            if timer: t = timer.clock()
+            X = self.batch_input
+            X[:n].fill(.5)
+            for i, im in enumerate(group):
+                self.letterbox_image_into(im, self.net_width, self.net_height, wrap_chw_array(X[i]))
+            if timer: t = timer.lap('letterbox', t)
+
+            self.set_batch_network(self.net, n)
+            self.predict(self.net, X.ctypes.data_as(POINTER(c_float)))
+            if timer: t = timer.lap('predict_batch', t)
+
+            arena = self.detections()
+            dets = arena.dets
+            engine = self.nms_engine if nms else None
+            pending = []
+            for i, im in enumerate(group):
+                num = arena.fill_batch(i, im.w, im.h, thresh, hier_thresh)
+                if timer: t = timer.lap('get_network_boxes', t)
+                if engine:
+                    #the whole group goes through the engine at once, after the loop
+                    pending.append((detection_view(dets, num).copy(), self.detection_probs(dets, num).copy()))
+                else:
+                    if (nms): self.do_nms_obj(dets, num, self.meta.classes, nms);
+                    if timer: t = timer.lap('do_nms_obj', t)
+                    if as_array:
+                        results.append(self.decode_detections_array(dets, num))
+                    else:
+                        results.append(self.decode_detections(dets, num))
+                if timer: t = timer.lap('decode', t)
+            if engine:
+                engine.suppress_batch(pending, nms, thresh)
+                if timer: t = timer.lap('nms', t)
+                for view, probs in pending:
+                    res = self.results_array(view, probs)
+                    results.append(res if as_array else res.tolist())
+                if timer: t = timer.lap('decode', t)
+
+        if draw:
+            renderer = self.renderer(use_alphabet, thresh)
+            for im, res in zip(images, results):
+                if timer: t = timer.clock()
+                renderer.draw(im, res)
+                if timer: timer.lap('draw', t)
+        return results
+
     def camera(self,cv_image):
-        t1 = time.time()
+        timer = self.timer
+        if timer: t1 = timer.clock()
         if self.input_width is None or self.input_height is None:
             self.input_height, self.input_width, self.input_channel = cv_image.shape
             self.step = self.dtype_itemsize * self.input_channel * self.input_width
 
         img_data_ctypes_ptr = cv_image.ravel().ctypes.data_as(POINTER(c_char_p))
-        im = self.make_image(self.input_width, self.input_height, self.input_channel)
-        self.float_to_image_lrt(self.step, img_data_ctypes_ptr, im)
-        self.rgbgr_image(im)
+        res = self.detect_frame(cv_image, thresh=.5, hier_thresh=.5, nms=.45)
 
-        res = self.detect(im,thresh=.5, hier_thresh=.5, nms=.45,use_alphabet=0)
+        #the IMAGE is only the drawing surface; reuses the per-resolution buffer, nothing to free
+        if timer: t = timer.clock()
+        im = self.frames.ingest(cv_image)
+        if timer: timer.lap('ingest', t)
+        self.renderer(0, .5).draw(im, res)
         self.image_to_float_lrt(im, img_data_ctypes_ptr)
-        self.free_image(im)
 
-        print 'DARKNET CAMERA Use time:{}'.format(time.time() - t1)
+        if timer: timer.lap('camera', t1)
         return res, cv_image
 
 
+    def load_timed(self, imgfile):
+        timer = self.timer
+        if timer: t = timer.clock()
+        im = self.load_image(imgfile, 0, 0)
+        if timer: timer.lap('ingest', t)
+        return im
+
+    def save_detected(self, im, imgfile):
+        timer = self.timer
+        if timer: t = timer.clock()
+        output = os.path.basename(imgfile)
+        self.save_image(im, imgfile.replace(output,"detect_{0}".format(output)))
+        self.free_image(im)
+        if timer: timer.lap('save', t)
+
     def run(self,toDetect,args):
         t1 = time.time()
-        if args.i:
-            im = self.load_image(toDetect, 0, 0)
-            r = self.detect(im)
-            output = os.path.basename(toDetect)
-            self.save_image(im, toDetect.replace(output,"detect_{0}".format(output)))
-            self.free_image(im)
-            print 'DARKNET Use time:{}'.format(time.time() - t1)
+        draw = not args.no_draw
+        sink = None
+        specs = (args.sink or []) + (['bin:' + args.det_file] if args.det_file else [])
+        if args.p and specs:
+            from sinks import Sinks, make_sink
+            sink = Sinks([make_sink(spec, self.names) for spec in specs])
+        tile = parse_tile(args.tile)
+        if args.i and tile:
+            r = self.detect_tiled(cv2.imread(toDetect), tile, args.overlap)
+            print 'RESULT:{}'.format(r)
+        elif args.i:
+            im = self.load_timed(toDetect)
+            r = self.detect(im, draw=draw)
+            if draw:
+                self.save_detected(im, toDetect)
+            else:
+                self.free_image(im)
+            logger.debug('DARKNET Use time:{}'.format(time.time() - t1))
             print 'RESULT:{}'.format(r)
 
-        if args.p:
-            filelist = os.listdir(toDetect)
-            for file in filelist:
-                if file.lower().endswith('.jpg'):
-                    imgfile = os.path.join(toDetect,file)
-                    output = os.path.basename(imgfile)
-                    im = self.load_image(imgfile, 0, 0)
-                    r = self.detect(im)
-                    self.save_image(im,imgfile.replace(output,"detect_{0}".format(output)))
-                    self.free_image(im)
+        if args.p and args.pipeline and not tile:
+            from pipeline import DirectoryPipeline
+            from sharded import list_images
+            filelist = list_images(toDetect)
+            p = DirectoryPipeline(self, readers=args.readers, writers=args.writers,
+                    read_depth=args.read_depth, write_depth=args.write_depth, draw=draw,
+                    thresh=args.thresh, sink=sink)
+            stats = p.run(filelist)
+            print 'DARKNET pipeline: {images} images, {seconds:.2f}s, {images_per_second:.2f} img/s'.format(**stats)
+        elif args.p and tile:
+            from sharded import list_images
+            for imgfile in list_images(toDetect):
+                frame = cv2.imread(imgfile)
+                r = self.detect_tiled(frame, tile, args.overlap, thresh=args.thresh)
+                if sink:
+                    sink.write(imgfile, r, frame.shape[1], frame.shape[0])
+                print 'RESULT:{}'.format(r)
+        elif args.p:
+            #drawing and saving go to the renderer, off the inference thread if render_workers > 0
+            renderer = self.renderer(workers=args.render_workers) if draw else None
+            from sharded import list_images
+            filelist = list_images(toDetect)
+            for start in range(0, len(filelist), self.batch):
+                group = filelist[start:start + self.batch]
+                ims = [self.load_timed(imgfile) for imgfile in group]
+                if self.batch > 1:
+                    rs = self.detect_batch(ims, thresh=args.thresh, draw=False)
+                else:
+                    rs = [self.detect(ims[0], thresh=args.thresh, draw=False)]
+                for imgfile, im, r in zip(group, ims, rs):
+                    if sink:
+                        sink.write(imgfile, r, im.w, im.h)
+                    if renderer:
+                        renderer.submit(im, r, lambda im, r, imgfile=imgfile: self.save_detected(im, imgfile))
+                    else:
+                        self.free_image(im)
                     print 'RESULT:{}'.format(r)
+            if renderer:
+                renderer.close()
+        if sink:
+            sink.close()
         if args.e:
+            timer = self.timer
+            if timer: t = timer.clock()
             image = cv2.imread(toDetect)
             im = array_to_image(image)
-            res = self.detect(im)
+            if timer: timer.lap('ingest', t)
+            res = self.detect(im, draw=False)
             for output in res:
                 box = output[-1]
                 top, left, bottom, right = box
@@ -322,29 +1266,88 @@ class darknet():
                 y = int(left) - h / 2
                 cv2.rectangle(image, (x,y), (x+w,y+h), (255,0,0), 1)
                 #cv2.putText(image, predicted_class, text_origin, self.font_face, self.font_scale, self.font_color, self.font_thickness)
-            print 'NEW TEST Use time:{}'.format(time.time() - t1)
+            logger.debug('NEW TEST Use time:{}'.format(time.time() - t1))
             print 'RESULT:{}'.format(res)
 
         if args.c:
             image = cv2.imread(toDetect)
             self.camera(image)
 
+        if args.s:
+            from stream import RealtimeStream
+            source = cv2.VideoCapture(int(toDetect) if toDetect.isdigit() else toDetect)
+            def show(frame, res, latency):
+                print 'RESULT:{}'.format(res)
+            stats = RealtimeStream(self, source, show).run()
+            print 'DARKNET stream:{}'.format(stats)
 
+        if self.timer:
+            for stage, st in sorted(self.timer.summary().items()):
+                print 'TIMING {0}: n={count} mean={mean_ms:.3f}ms p50={p50_ms:.3f}ms p95={p95_ms:.3f}ms p99={p99_ms:.3f}ms'.format(stage, **st)
+            print 'MEMORY ' + ' '.join('{0}={1}'.format(k, v) for k, v in sorted(self.memory_stats().items()))
+            if args.timing:
+                self.timer.dump(args.timing)
 
-    
-if __name__ == "__main__":
-    import process_logging
-    process_logging.initLogging("/tmp/test_detect.log")
+
+
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('vocData',help=('The voc.data of this model trained'))
-    parser.add_argument('toDetectImage',help=('To be detect Image file'))
+    parser.add_argument('toDetectImage',help=('To be detect Image file; for -p a directory or a dataset manifest .npz'))
     parser.add_argument('-i', action='store_true', default=False, help=('To detect image file with darknet pointer'))
     parser.add_argument('-p', action='store_true', default=False, help=('To detect image path with darknet pointer'))
     parser.add_argument('-c', action='store_true', default=False, help=('To detect image file with cv2 and darknet pointer'))
     parser.add_argument('-e', action='store_true', default=False, help=('To detect image file with cv2 easy change'))
-    args = parser.parse_args()
+    parser.add_argument('-s', action='store_true', default=False, help=('To detect a video file or camera index in real time, dropping stale frames'))
+    parser.add_argument('-b', '--batch', type=int, default=1, help=('Images per forward pass in -p mode'))
+    parser.add_argument('-n', '--no-draw', action='store_true', default=False, help=('Headless: do not draw or save detect_ images'))
+    parser.add_argument('--render-workers', type=int, default=0, help=('Threads drawing and saving -p images off the inference thread'))
+    parser.add_argument('-P', '--pipeline', action='store_true', default=False, help=('-p with prefetching readers and async writers'))
+    parser.add_argument('--readers', type=int, default=2, help=('Pipeline image decode threads'))
+    parser.add_argument('--writers', type=int, default=2, help=('Pipeline draw/save threads'))
+    parser.add_argument('--read-depth', type=int, default=16, help=('Decoded images queued ahead of inference'))
+    parser.add_argument('--write-depth', type=int, default=16, help=('Detected images queued for the writers'))
+    parser.add_argument('--det-file', default=None, help=('-p: also write all detections to this binary file for voc_eval, as --sink bin:'))
+    parser.add_argument('--sink', action='append', default=None, metavar='KIND:PATH',
+            help=('-p: also stream results to jsonl:<file>, comp4:<dir or prefix>, coco:<file> or bin:<file>; repeatable'))
+    parser.add_argument('--thresh', type=float, default=.5, help=('-p detection threshold, about .005 for mAP sinks'))
+    parser.add_argument('--nms', default='c', choices=['c', 'obj', 'class', 'soft'], help=('NMS: the C do_nms_obj, or a numpy engine mode (see nms.py)'))
+    parser.add_argument('--nms-top-k', type=int, default=None, help=('numpy NMS: candidates kept per image before suppression'))
+    parser.add_argument('--nms-sigma', type=float, default=.5, help=('numpy NMS: soft mode decay'))
+    parser.add_argument('--tile', default=None, metavar='WxH', help=('-i/-p: detect in tiles of this size (or WxW), for images much larger than the network; no drawing'))
+    parser.add_argument('--overlap', type=float, default=.2, help=('--tile: overlap of neighbouring tiles, a fraction of the tile'))
+    parser.add_argument('-j', '--procs', type=int, default=1, help=('-p with this many worker processes, one network each'))
+    parser.add_argument('--threads', type=int, default=1, help=('BLAS/OpenMP threads per worker process'))
+    parser.add_argument('-t', '--timing', nargs='?', const='', default=None, help=('Per-stage timings, dumped as JSON to this file if given'))
+    parser.add_argument('--so', default='../libdarknet.so', help=('libdarknet.so to load'))
+    return parser
+
 
-    d = darknet(args.vocData)
-    d.run(args.toDetectImage,args)
+if __name__ == "__main__":
+    import process_logging
+    process_logging.initLogging("/tmp/test_detect.log")
+    args = make_parser().parse_args()
+    engine = None
+    if args.nms != 'c':
+        from nms import NMS
+        engine = NMS(args.nms, args.nms_top_k, args.nms_sigma)
+
+    if args.p and args.procs > 1:
+        if args.det_file or args.sink:
+            make_parser().error('--det-file and --sink are not supported with -j')
+        if args.timing is not None:
+            make_parser().error('-t is not supported with -j')
+        from sharded import ShardedRunner
+        t1 = time.time()
+        runner = ShardedRunner(args.vocData, soFile=args.so, procs=args.procs, threads=args.threads,
+                batch=args.batch, draw=not args.no_draw, nms_engine=engine, thresh=args.thresh,
+                tile=parse_tile(args.tile), overlap=args.overlap)
+        for imgfile, r in runner.imap(args.toDetectImage):
+            print 'RESULT:{}'.format(r)
+        runner.close()
+        logger.info('DARKNET Use time:{}'.format(time.time() - t1))
+    else:
+        d = darknet(args.vocData, soFile=args.so, batch=args.batch, timing=args.timing is not None, nms_engine=engine)
+        d.run(args.toDetectImage,args)
     logger.info("test over")
     
@@ -0,0 +1,94 @@
+"""Binary detection results, the format `detector valid` writes with eval=vocbin.
+
+A 32 byte header, one RECORD per (detection, class) with a nonzero prob,
+then the image ids and the class names, each newline terminated.
+record['image'] and record['class_id'] index those two lists. Boxes are
+the 1-based corners clamped to the image, as in the comp4_det text files,
+so scripts/voc_eval.py reads either.
+"""
+import os
+import struct
+
+import numpy as np
+
+MAGIC = 'DKDT'
+VERSION = 1
+HEADER = struct.Struct('<4siqqii')
+RECORD = np.dtype([('image', '<i4'), ('class_id', '<i4'), ('score', '<f4'),
+                   ('xmin', '<f4'), ('ymin', '<f4'), ('xmax', '<f4'), ('ymax', '<f4')])
+
+def image_id(imgfile):
+    """basecfg() of a path: the file name without directory and extension"""
+    return os.path.splitext(os.path.basename(imgfile))[0]
+
+def result_columns(res, class_index):
+    """class ids, scores and float64 x, y, w, h of a detect() result, list or
+    Detections; class_index maps names to ids for lists"""
+    if hasattr(res, 'array'):
+        a = res.array
+        return (a['class_id'], a['score']) + tuple(a[k].astype(np.float64) for k in ('x', 'y', 'w', 'h'))
+    class_ids = np.array([class_index[name] for name, prob, box in res], dtype=np.int32)
+    scores = np.array([prob for name, prob, box in res], dtype=np.float32)
+    boxes = np.array([box for name, prob, box in res], dtype=np.float64).reshape(-1, 4)
+    return (class_ids, scores) + tuple(boxes.T)
+
+def corner_boxes(x, y, bw, bh, w, h):
+    """float32 1-based corners clamped to a w x h image, as print_detector_detections"""
+    return (np.maximum(x - bw / 2. + 1, 1).astype(np.float32),
+            np.maximum(y - bh / 2. + 1, 1).astype(np.float32),
+            np.minimum(x + bw / 2. + 1, w).astype(np.float32),
+            np.minimum(y + bh / 2. + 1, h).astype(np.float32))
+
+class DetectionFileWriter(object):
+    """Append detect() results for one image at a time, ids are written on close()."""
+    def __init__(self, path, names):
+        self.path = path
+        self.names = list(names)
+        self.class_index = dict((name, i) for i, name in enumerate(self.names))
+        self.image_ids = []
+        self.count = 0
+        self.f = open(path, 'wb')
+        self.f.write(HEADER.pack(MAGIC, VERSION, 0, 0, 0, 0))
+
+    def write(self, imgfile, res, w, h):
+        """res is a detect() result for imgfile, a w x h image"""
+        class_ids, scores, x, y, bw, bh = result_columns(res, self.class_index)
+        rec = np.empty(len(scores), dtype=RECORD)
+        rec['class_id'] = class_ids
+        rec['score'] = scores
+        rec['image'] = len(self.image_ids)
+        rec['xmin'], rec['ymin'], rec['xmax'], rec['ymax'] = corner_boxes(x, y, bw, bh, w, h)
+        self.image_ids.append(image_id(imgfile))
+        rec.tofile(self.f)
+        self.count += len(rec)
+
+    def close(self):
+        if self.f is None:
+            return
+        names_offset = self.f.tell()
+        self.f.write(''.join(x + '\n' for x in self.image_ids))
+        self.f.write(''.join(x + '\n' for x in self.names))
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, self.count, names_offset, len(self.image_ids), len(self.names)))
+        self.f.close()
+        self.f = None
+
+def is_detection_file(path):
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def read_detection_file(path):
+    """image_ids, names, records of a detection file; records is a read-only memmap"""
+    with open(path, 'rb') as f:
+        magic, version, count, names_offset, nimages, nclasses = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{0}: not a version {1} detection file'.format(path, VERSION))
+        f.seek(names_offset)
+        strings = f.read().split('\n')
+    if count:
+        records = np.memmap(path, dtype=RECORD, mode='r', offset=HEADER.size, shape=(count,))
+    else:
+        records = np.zeros(0, dtype=RECORD)
+    return strings[:nimages], strings[nimages:nimages + nclasses], records
@@ -0,0 +1,204 @@
+"""Non-maximum suppression in numpy, on decoded detections.
+
+An NMS engine works on what detection_view() and get_detection_probs()
+give for one image: a structured array with x, y, w, h (box centre and
+size) and objectness fields, and the (num, classes) prob matrix. Like the
+C side it zeroes the probs of suppressed detections, so the result
+decodes the same way.
+
+Modes:
+    obj     do_nms_obj: class agnostic, by objectness; a suppressed
+            detection loses all its classes
+    class   do_nms_sort: each class on its own, by that class's prob
+    soft    Gaussian soft-NMS per class: overlapping scores decay by
+            exp(-iou^2 / sigma) instead of dropping to zero, and only
+            fall out below the detection threshold
+
+Groups that must not suppress each other (images of a batch, classes in
+class and soft modes) are moved apart by a coordinate offset, so every
+mode is a single pass over all candidates of all images. Results agree
+with the C functions up to float rounding of overlaps at the threshold,
+and the order of equal scores, which qsort leaves unspecified there.
+"""
+import numpy as np
+
+MODES = ('obj', 'class', 'soft')
+
+def corners(dets):
+    """(n, 4) float64 x1, y1, x2, y2 of the x, y, w, h fields of dets"""
+    x, y, w, h = [dets[k].astype(np.float64) for k in ('x', 'y', 'w', 'h')]
+    return np.stack([x - w / 2, y - h / 2, x + w / 2, y + h / 2], axis=1)
+
+def offset_groups(boxes, groups):
+    """boxes shifted by group, far enough that no two groups overlap"""
+    if len(boxes) == 0:
+        return boxes
+    extent = np.ceil(boxes.max() - boxes.min()) + 1
+    return boxes + (groups * extent)[:, None]
+
+def overlapping_pairs(boxes, thresh, chunk=1 << 20):
+    """(a, b, iou) of the box pairs overlapping by more than thresh.
+
+    A sweep along x: with boxes sorted by x1, the only boxes that can
+    overlap box a follow it up to the first x1 past its x2. An IoU above
+    thresh also needs an x overlap above thresh times a's width, which
+    ends the window sooner. Groups moved apart by offset_groups() never
+    meet, so pairs stay within a group.
+    """
+    n = len(boxes)
+    order = np.argsort(boxes[:, 0], kind='mergesort')
+    x1, y1, x2, y2 = [np.ascontiguousarray(c) for c in boxes[order].T]
+    area = (x2 - x1) * (y2 - y1)
+    ends = np.searchsorted(x1, x2 - thresh * (x2 - x1), side='left')
+    counts = np.maximum(ends - np.arange(n) - 1, 0)
+    cum = np.cumsum(counts)
+    out = []
+    start = 0
+    while start < n:
+        #whole boxes per chunk, about chunk pairs each
+        stop = max(start + 1, np.searchsorted(cum, cum[start] - counts[start] + chunk, side='right'))
+        c = counts[start:stop]
+        i = np.repeat(np.arange(start, stop), c)
+        j = i + 1 + np.arange(len(i)) - np.repeat(np.cumsum(c) - c, c)
+        #x overlaps are positive by construction, drop the pairs apart in y first
+        h = np.minimum(y2[i], y2[j]) - np.maximum(y1[i], y1[j])
+        near = np.nonzero(h > 0)[0]
+        i, j, h = i[near], j[near], h[near]
+        inter = (np.minimum(x2[i], x2[j]) - x1[j]) * h
+        iou = inter / (area[i] + area[j] - inter)
+        hit = iou > thresh
+        out.append((order[i[hit]], order[j[hit]], iou[hit]))
+        start = stop
+    if not out:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+    return tuple(np.concatenate(x) for x in zip(*out))
+
+def ranks(scores):
+    """position of each score in the greedy order, ties by index"""
+    r = np.empty(len(scores), dtype=np.int64)
+    r[np.argsort(-scores, kind='mergesort')] = np.arange(len(scores))
+    return r
+
+def greedy(boxes, scores, thresh):
+    """Mask of the boxes greedy NMS keeps.
+
+    A box is kept when none of the better boxes overlapping it is kept.
+    Rather than walking the boxes in score order this settles all of them
+    in rounds: boxes whose better neighbours are all dropped are kept,
+    boxes with a kept better neighbour are dropped. Each round settles at
+    least the best unsettled box, and usually far more.
+    """
+    a, b, iou = overlapping_pairs(boxes, thresh)
+    r = ranks(scores)
+    hi = np.where(r[a] < r[b], a, b)
+    lo = np.where(r[a] < r[b], b, a)
+    #0 unsettled, 1 kept, -1 dropped
+    state = np.zeros(len(scores), dtype=np.int8)
+    while True:
+        state[lo[state[hi] == 1]] = -1
+        blocked = np.zeros(len(scores), dtype=np.bool)
+        blocked[lo[state[hi] == 0]] = True
+        state[(state == 0) & ~blocked] = 1
+        live = state[lo] == 0
+        if not live.any():
+            return state == 1
+        hi, lo = hi[live], lo[live]
+
+def soft(boxes, scores, sigma, score_thresh):
+    """Gaussian soft-NMS; returns the decayed scores, zero where they fell
+    to score_thresh or below."""
+    n = len(scores)
+    a, b, iou = overlapping_pairs(boxes, 0.)
+    #both directions, grouped by box
+    src = np.concatenate([a, b])
+    dst = np.concatenate([b, a])
+    decay = np.exp(-np.concatenate([iou, iou]) ** 2 / sigma)
+    order = np.argsort(src, kind='mergesort')
+    dst, decay = dst[order], decay[order]
+    starts = np.searchsorted(src[order], np.arange(n + 1))
+    scores = scores.astype(np.float64)
+    left = np.where(scores > score_thresh, scores, -np.inf)
+    #boxes overlapping nothing keep their score, only the rest need the loop
+    alone = starts[1:] == starts[:-1]
+    out = np.where(alone & (left > score_thresh), scores, 0.)
+    left[alone] = -np.inf
+    while n:
+        i = np.argmax(left)
+        if left[i] == -np.inf:
+            break
+        out[i] = left[i]
+        left[i] = -np.inf
+        #boxes already taken or gone stay at -inf
+        s = slice(starts[i], starts[i + 1])
+        d = dst[s]
+        left[d] *= decay[s]
+        left[d[left[d] <= score_thresh]] = -np.inf
+    return out
+
+class NMS(object):
+    """NMS engine for darknet.detect() and detect_batch(), see the module doc.
+
+    top_k keeps only the k best candidates of each image before
+    suppression; sigma is the soft-NMS decay.
+    """
+    def __init__(self, mode='obj', top_k=None, sigma=.5):
+        if mode not in MODES:
+            raise ValueError("unknown nms mode {0}, expected one of {1}".format(mode, ', '.join(MODES)))
+        self.mode = mode
+        self.top_k = top_k
+        self.sigma = sigma
+
+    def suppress(self, dets, probs, thresh, score_thresh=0.):
+        """Suppress in place in probs; thresh is the IoU threshold."""
+        self.suppress_batch([(dets, probs)], thresh, score_thresh)
+        return probs
+
+    def suppress_batch(self, items, thresh, score_thresh=0.):
+        """suppress() over [(dets, probs)] of several images in one pass"""
+        rows, cols, scores, boxes, groups = [], [], [], [], []
+        for image, (dets, probs) in enumerate(items):
+            if self.mode == 'obj':
+                r = np.nonzero(dets['objectness'] > 0)[0]
+                c = np.zeros(len(r), dtype=np.int64)
+                s = dets['objectness'][r]
+            else:
+                r, c = np.nonzero(probs > 0)
+                s = probs[r, c]
+            if self.top_k is not None and len(s) > self.top_k:
+                best = np.argsort(-s, kind='mergesort')[:self.top_k]
+                best.sort()
+                r, c, s = r[best], c[best], s[best]
+            rows.append(r)
+            cols.append(c)
+            scores.append(s)
+            boxes.append(corners(dets[r]))
+            groups.append(image * probs.shape[1] + c)
+        if not items:
+            return
+        scores = np.concatenate(scores)
+        boxes = np.concatenate(boxes)
+        #no overlap with a non-finite box passes the threshold in C either
+        finite = np.isfinite(boxes).all(axis=1)
+        boxes = offset_groups(boxes[finite], np.concatenate(groups)[finite])
+        if self.mode == 'soft':
+            out = np.where(scores > score_thresh, scores, 0.)
+            out[finite] = soft(boxes, scores[finite], self.sigma, score_thresh)
+        else:
+            out = np.ones(len(scores), dtype=np.bool)
+            out[finite] = greedy(boxes, scores[finite], thresh)
+        start = 0
+        for (dets, probs), r, c in zip(items, rows, cols):
+            o = out[start:start + len(r)]
+            start += len(r)
+            if self.mode == 'obj':
+                #candidates keep their probs, the rest of the image is gone
+                mask = np.zeros(len(probs), dtype=np.bool)
+                mask[r[o > 0]] = True
+                probs[~mask] = 0
+            elif self.mode == 'class':
+                kept = np.zeros(probs.shape, dtype=np.bool)
+                kept[r[o > 0], c[o > 0]] = True
+                probs[~kept] = 0
+            else:
+                probs[...] = 0
+                probs[r, c] = o
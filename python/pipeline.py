@@ -0,0 +1,158 @@
+import os
+import time
+import logging
+import threading
+import Queue
+
+logger = logging.getLogger(__name__)
+
+#end of stream marker between stages
+DONE = None
+
+class DirectoryPipeline(object):
+    """Streaming -p mode: decode, detect and write in overlapping stages.
+
+    reader threads load images into a queue of at most read_depth decoded
+    images, the owning thread runs detection (dn.batch images per forward
+    pass), and writer threads draw, save and report results from a queue
+    of at most write_depth. Full queues block the stage feeding them, so
+    memory stays bounded whatever the size of the directory.
+
+    dn is a darknet instance. on_result(imgfile, res) runs on a writer
+    thread; it defaults to printing the RESULT line like run() does.
+    Images that fail to load are logged, listed in self.failed and
+    skipped.
+    sink, a sinks.py sink, also gets every result.
+    """
+    def __init__(self, dn, readers=2, writers=2, read_depth=16, write_depth=16,
+            draw=True, use_alphabet=1, thresh=.5, on_result=None, sink=None):
+        self.dn = dn
+        self.readers = readers
+        self.writers = writers
+        self.read_depth = read_depth
+        self.write_depth = write_depth
+        self.draw = draw
+        self.thresh = thresh
+        self.renderer = dn.renderer(use_alphabet, thresh) if draw else None
+        self.on_result = on_result or self.print_result
+        self.sink = sink
+        self.print_lock = threading.Lock()
+        self.failed = []
+        self.stats = {}
+
+    def print_result(self, imgfile, res):
+        with self.print_lock:
+            print 'RESULT:{}'.format(res)
+
+    def read(self, files, ready):
+        #DONE goes out whatever happens, run() counts one per reader
+        try:
+            while True:
+                try:
+                    imgfile = files.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    im = self.dn.load_timed(imgfile)
+                except Exception:
+                    logger.exception("read failed for {0}".format(imgfile))
+                    with self.print_lock:
+                        self.failed.append(imgfile)
+                    continue
+                ready.put((imgfile, im))
+        finally:
+            ready.put(DONE)
+
+    def write(self, done):
+        while True:
+            item = done.get()
+            if item is DONE:
+                return
+            imgfile, im, res = item
+            try:
+                if self.sink:
+                    with self.print_lock:
+                        self.sink.write(imgfile, res, im.w, im.h)
+                if self.draw:
+                    timer = self.dn.timer
+                    if timer: t = timer.clock()
+                    self.renderer.draw(im, res)
+                    if timer: timer.lap('draw', t)
+                    self.dn.save_detected(im, imgfile)
+                else:
+                    self.dn.free_image(im)
+                self.on_result(imgfile, res)
+            except Exception:
+                logger.exception("write failed for {0}".format(imgfile))
+
+    def start(self, target, n, name, *args):
+        threads = []
+        for i in range(n):
+            t = threading.Thread(target=target, args=args, name="{0}-{1}".format(name, i))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        return threads
+
+    def run(self, filelist):
+        t0 = time.time()
+        self.failed = []
+        files = Queue.Queue()
+        for f in filelist:
+            files.put(f)
+        ready = Queue.Queue(self.read_depth)
+        done = Queue.Queue(self.write_depth)
+
+        readers = self.start(self.read, self.readers, "reader", files, ready)
+        writers = self.start(self.write, self.writers, "writer", done)
+
+        count = 0
+        wait = 0.
+        infer = 0.
+        running = len(readers)
+        while running:
+            t1 = time.time()
+            item = ready.get()
+            batch = []
+            while True:
+                if item is DONE:
+                    running -= 1
+                else:
+                    batch.append(item)
+                if len(batch) == self.dn.batch or not running:
+                    break
+                try:
+                    item = ready.get_nowait()
+                except Queue.Empty:
+                    break
+            t2 = time.time()
+            wait += t2 - t1
+            if not batch:
+                continue
+
+            ims = [im for imgfile, im in batch]
+            if self.dn.batch > 1:
+                rs = self.dn.detect_batch(ims, thresh=self.thresh, draw=False)
+            else:
+                rs = [self.dn.detect(ims[0], thresh=self.thresh, draw=False)]
+            infer += time.time() - t2
+
+            for (imgfile, im), res in zip(batch, rs):
+                done.put((imgfile, im, res))
+            count += len(batch)
+
+        for t in writers:
+            done.put(DONE)
+        for t in readers + writers:
+            t.join()
+
+        elapsed = time.time() - t0
+        self.stats = {'images': count,
+                      'failed': len(self.failed),
+                      'seconds': elapsed,
+                      'images_per_second': count / elapsed if elapsed > 0 else 0.,
+                      'input_wait_seconds': wait,
+                      'inference_seconds': infer}
+        logger.info("pipeline: {images} images ({failed} unreadable) in {seconds:.2f}s, {images_per_second:.2f} img/s, "
+                "inference {inference_seconds:.2f}s, waiting for input {input_wait_seconds:.2f}s".format(**self.stats))
+        return self.stats
@@ -1,38 +1,30 @@
-from darknet_0 import *
+import argparse
 
-def predict_tactic(net, s):
-    prob = 0
-    d = c_array(c_float, [0.0]*256)
-    tac = ''
+from rnn import Generator
+
+def predict_tactics(gen, s, n, beam=False, temperature=1.):
+    """n tactics following s as (tactic, log probability), best first:
+    sampled, or the n most likely with beam"""
     if not len(s):
         s = '\n'
-    for c in s[:-1]:
-        d[ord(c)] = 1
-        pred = predict(net, d)
-        d[ord(c)] = 0
-    c = s[-1]
-    while 1:
-        d[ord(c)] = 1
-        pred = predict(net, d)
-        d[ord(c)] = 0
-        pred = [pred[i] for i in range(256)]
-        ind = sample(pred)
-        c = chr(ind)
-        prob += math.log(pred[ind])
-        if len(tac) and tac[-1] == '.':
-            break
-        tac = tac + c
-    return (tac, prob)
+    if beam:
+        return gen.beam_search(s, n, stop='.')
+    return gen.sample(s, n, temperature, stop='.')
 
-def predict_tactics(net, s, n):
-    tacs = []
-    for i in range(n):
-        reset_rnn(net)
-        tacs.append(predict_tactic(net, s))
-    tacs = sorted(tacs, key=lambda x: -x[1])
-    return tacs
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Proof tactics from a character rnn')
+    #cfg/coq.test.cfg with /home/pjreddie/backup/coq.backup
+    parser.add_argument('cfg', nargs='?', default='cfg/rnn.cfg')
+    parser.add_argument('weights', nargs='?', default=None)
+    parser.add_argument('--prefix', default='+++++\n')
+    parser.add_argument('-n', type=int, default=1, help='tactics to return')
+    parser.add_argument('-b', '--batch', type=int, default=16, help='sequences per forward pass')
+    parser.add_argument('--beam', action='store_true', help='beam search of width n instead of sampling')
+    parser.add_argument('--temperature', type=float, default=1.)
+    parser.add_argument('--so', default='../libdarknet.so')
+    args = parser.parse_args()
 
-#net = load_net("cfg/coq.test.cfg", "/home/pjreddie/backup/coq.backup", 0)
-net =load_net("/home/crow/workspace/BBA/aiDATA/a_image_VOC_factory/VOCdevkit/sq/cfg/yolov3-voc.cfg","/home/crow/workspace/BBA/aiDATA/a_image_VOC_factory/VOCdevkit/sq/weights/yolov3-voc_final.weights", 0)
-t = predict_tactics(net, "+++++\n", 1)
-print t
+    batch = max(args.batch, args.n) if args.beam else min(args.batch, args.n)
+    gen = Generator(args.cfg, args.weights, batch=batch, soFile=args.so)
+    t = predict_tactics(gen, args.prefix, args.n, args.beam, args.temperature)
+    print t
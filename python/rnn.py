@@ -0,0 +1,155 @@
+"""Text generation with darknet's character networks (cfg/rnn.cfg, cfg/gru.cfg).
+
+A Generator loads the network with one sequence per batch row and a single
+time step, so every forward pass advances all the sequences by one
+character: the input is a (batch, 256) one-hot matrix and the softmax comes
+back as a numpy view of the same shape. sample() draws the next character
+of every row at once; beam_search() forks and drops sequences by moving
+their recurrent state between rows with reorder_network_state. Many
+candidates then cost one forward pass per character, not one per
+candidate and character.
+"""
+import os
+
+import numpy as np
+from ctypes import c_float, c_int, POINTER
+
+from darknet import load_lib, write_atomic
+
+#[net] options of a generation cfg
+GENERATE_OPTIONS = ('batch', 'subdivisions', 'time_steps')
+
+def generate_cfg(cfgfile, batch):
+    """A copy of cfgfile, next to it, that runs batch sequences one character per pass"""
+    base, name = os.path.split(cfgfile)
+    out_file = os.path.join(base, 'generate-b{0}-{1}'.format(batch, name))
+    out = []
+    with open(cfgfile, 'r') as f:
+        for line in f:
+            if line.split('=')[0].strip().lower() in GENERATE_OPTIONS:
+                continue
+            out.append(line)
+            if line.strip().lower() in ('[net]', '[network]'):
+                out.append('batch={0}\nsubdivisions=1\ntime_steps=1\n'.format(batch))
+    write_atomic(out_file, ''.join(out))
+    return out_file
+
+def sample_rows(probs, temperature=1., rng=np.random):
+    """One index per row of probs, drawn as darknet.sample() does from the
+    row's distribution raised to 1/temperature; 0 takes the most likely."""
+    if temperature <= 0:
+        return probs.argmax(axis=1)
+    p = probs.astype(np.float64)
+    if temperature != 1.:
+        p **= 1. / temperature
+    cum = np.cumsum(p, axis=1)
+    u = rng.uniform(size=(len(p), 1)) * cum[:, -1:]
+    return np.minimum((cum < u).sum(axis=1), p.shape[1] - 1)
+
+class Generator(object):
+    """A character network run on batch sequences in lockstep, see the module doc."""
+    def __init__(self, cfgfile, weightfile=None, batch=16, soFile='../libdarknet.so', seed=None):
+        self.lib = load_lib(soFile)
+        self.batch = batch
+        self.net = self.lib.load_network(generate_cfg(cfgfile, batch), weightfile, 0)
+        self.inputs = self.lib.network_inputs(self.net)
+        self.outputs = self.lib.network_outputs(self.net)
+        self.X = np.zeros((batch, self.inputs), dtype=np.float32)
+        self.rows = np.arange(batch)
+        self.index = np.zeros(batch, dtype=np.int32)
+        self.rng = np.random.RandomState(seed)
+
+    def reset(self):
+        for b in range(self.batch):
+            self.lib.reset_network_state(self.net, b)
+
+    def step(self, chars):
+        """Feed chars[i] to sequence i, the rows past len(chars) get no input.
+
+        Returns the (batch, outputs) distribution of the next characters, a
+        view of the network's output good until the next step.
+        """
+        X = self.X
+        X.fill(0)
+        X[self.rows[:len(chars)], chars] = 1
+        out = self.lib.network_predict(self.net, X.ctypes.data_as(POINTER(c_float)))
+        return np.ctypeslib.as_array(out, shape=(self.batch, self.outputs))
+
+    def prime(self, prefix):
+        """Reset every sequence and feed it prefix; returns step()'s last view"""
+        self.reset()
+        probs = None
+        for c in prefix:
+            probs = self.step(np.full(self.batch, ord(c), dtype=np.int64))
+        return probs
+
+    def keep(self, index):
+        """Sequence i continues from where sequence index[i] was"""
+        n = len(index)
+        self.index[:n] = index
+        self.lib.reorder_network_state(self.net, self.index.ctypes.data_as(POINTER(c_int)), n)
+
+    def sample(self, prefix, n, temperature=1., stop='.', max_len=256):
+        """n sampled continuations of prefix up to and including stop, or
+        max_len characters, as (text, log probability), best first.
+        Sequences run self.batch at a time."""
+        results = []
+        for start in range(0, n, self.batch):
+            m = min(self.batch, n - start)
+            rows = self.rows[:m]
+            probs = self.prime(prefix)
+            logp = np.zeros(m)
+            live = np.ones(m, dtype=np.bool)
+            length = np.zeros(m, dtype=np.int64)
+            history = []
+            for i in range(max_len):
+                p = probs[:m]
+                chars = sample_rows(p, temperature, self.rng)
+                logp[live] += np.log(p[rows, chars][live])
+                length[live] += 1
+                history.append(chars.astype(np.uint8))
+                if stop is not None:
+                    live &= chars != ord(stop)
+                if not live.any():
+                    break
+                probs = self.step(chars)
+            text = np.stack(history, axis=1)
+            results.extend((text[i, :length[i]].tostring(), float(logp[i])) for i in range(m))
+        return sorted(results, key=lambda x: -x[1])
+
+    def beam_search(self, prefix, width=None, stop='.', max_len=256):
+        """The width most likely continuations of prefix up to and including
+        stop, as (text, log probability), best first; sequences still open
+        after max_len characters compete as they are.
+
+        Every step extends each open sequence by every character and keeps
+        the width best, one batch row each, so width is at most self.batch.
+        """
+        width = min(width or self.batch, self.batch)
+        probs = self.prime(prefix)
+        texts = ['']
+        scores = np.zeros(1)
+        done = []
+        for i in range(max_len):
+            n = len(texts)
+            logp = (scores[:, None] + np.log(probs[:n].astype(np.float64))).ravel()
+            k = min(width, len(logp))
+            best = np.argpartition(-logp, k - 1)[:k]
+            best = best[np.argsort(-logp[best], kind='mergesort')]
+            src, chars = np.divmod(best, self.outputs)
+            grown = [texts[s] + chr(c) for s, c in zip(src, chars)]
+            scores = logp[best]
+            open_ = np.ones(k, dtype=np.bool) if stop is None else chars != ord(stop)
+            done.extend((t, float(s)) for t, s, o in zip(grown, scores, open_) if not o)
+            if len(done) >= width:
+                #scores only fall, an open sequence below the width-th best finished one is out
+                open_ &= scores > sorted(s for t, s in done)[-width]
+            if not open_.any():
+                texts = []
+                break
+            texts = [t for t, o in zip(grown, open_) if o]
+            scores = scores[open_]
+            self.keep(src[open_])
+            probs = self.step(chars[open_])
+        done.extend(zip(texts, scores.tolist()))
+        return sorted(done, key=lambda x: -x[1])[:width]
@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import socket
+import logging
+import argparse
+import threading
+import Queue
+import httplib
+import collections
+import BaseHTTPServer
+import SocketServer
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#samples kept for the queue time percentiles
+STATS_WINDOW = 10000
+
+class Request(object):
+    def __init__(self, path=None, data=None):
+        self.path = path
+        self.data = data
+        self.queued = time.time()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class MicroBatcher(object):
+    """Collects concurrent requests into batches for warm darknet instances.
+
+    One thread per instance takes the first waiting request, then keeps
+    collecting until it has max_batch requests or max_wait seconds have
+    passed since that first one, and detects them in one detect_batch().
+    """
+    def __init__(self, instances, max_batch=8, max_wait=.005, thresh=.5, hier_thresh=.5, nms=.45):
+        self.instances = instances
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.thresh = thresh
+        self.hier_thresh = hier_thresh
+        self.nms = nms
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.queue_times = collections.deque(maxlen=STATS_WINDOW)
+        self.batch_sizes = collections.Counter()
+        self.threads = []
+        for i, dn in enumerate(instances):
+            t = threading.Thread(target=self.work, args=(dn,), name="batcher-{0}".format(i))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, req):
+        self.queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = batch[0].queued + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(True, timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return batch
+
+    def load(self, dn, req):
+        #returns the IMAGE and whether darknet owns its memory
+        if req.path is not None:
+            return dn.load_image(req.path, 0, 0), True
+        from darknet import frame_to_image
+        frame = cv2.imdecode(np.frombuffer(req.data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ValueError("cannot decode image data")
+        return frame_to_image(frame), False
+
+    def work(self, dn):
+        while True:
+            batch = self.collect()
+            start = time.time()
+            ready = []
+            ims = []
+            for req in batch:
+                try:
+                    ims.append(self.load(dn, req))
+                    ready.append(req)
+                except Exception as e:
+                    req.error = e
+                    req.done.set()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                for req in batch:
+                    self.queue_times.append(start - req.queued)
+            try:
+                rs = dn.detect_batch([im for im, owned in ims], thresh=self.thresh,
+                        hier_thresh=self.hier_thresh, nms=self.nms, draw=False)
+                for req, res in zip(ready, rs):
+                    req.result = res
+            except Exception as e:
+                logger.exception("batch failed")
+                for req in ready:
+                    req.error = e
+            for im, owned in ims:
+                if owned:
+                    dn.free_image(im)
+            for req in ready:
+                req.done.set()
+
+    def stats(self):
+        with self.lock:
+            q = np.array(self.queue_times) * 1000.
+            sizes = dict(self.batch_sizes)
+        out = {'batch_sizes': sizes, 'queue_ms': {}}
+        if len(q):
+            for p in (50, 95, 99):
+                out['queue_ms']['p{0}'.format(p)] = float(np.percentile(q, p))
+            out['queue_ms']['max'] = float(q.max())
+        out['requests'] = sum(k * v for k, v in sizes.items())
+        return out
+
+def to_json(res):
+    return [[name, float(score), [float(v) for v in box]] for name, score, box in res]
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """POST /detect with a JSON {"path": ...} or raw image bytes, GET /stats."""
+
+    def address_string(self):
+        #unix socket clients have no host
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'unix'
+
+    def reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, self.server.batcher.stats())
+        else:
+            self.reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/detect':
+            self.reply(404, {'error': 'not found'})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.getheader('Content-Length', 0)))
+            if self.headers.getheader('Content-Type', '').startswith('application/json'):
+                req = Request(path=json.loads(body)['path'].encode('utf-8'))
+            else:
+                req = Request(data=body)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.reply(400, {'error': 'bad request: {0!r}'.format(e)})
+            return
+        try:
+            res = self.server.batcher.submit(req)
+        except Exception as e:
+            self.reply(400, {'error': str(e)})
+            return
+        self.reply(200, {'result': to_json(res)})
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+def make_server(batcher, address):
+    """HTTP server on a (host, port) tuple or on a UNIX socket path."""
+    if isinstance(address, basestring):
+        server = UnixHTTPServer(address, Handler)
+    else:
+        server = HTTPServer(address, Handler)
+    server.batcher = batcher
+    return server
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+class Client(object):
+    """Local client; results come back in the detect() tuple format."""
+    def __init__(self, address, timeout=60):
+        self.address = address
+        self.timeout = timeout
+
+    def connection(self):
+        if isinstance(self.address, basestring):
+            return UnixHTTPConnection(self.address, self.timeout)
+        return httplib.HTTPConnection(self.address[0], self.address[1], timeout=self.timeout)
+
+    def call(self, method, path, body=None, content_type=None):
+        conn = self.connection()
+        try:
+            headers = {'Content-Type': content_type} if content_type else {}
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            out = json.loads(resp.read())
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise RuntimeError(out.get('error', resp.status))
+        return out
+
+    def detect_path(self, path):
+        out = self.call('POST', '/detect', json.dumps({'path': os.path.abspath(path)}), 'application/json')
+        return [(name.encode('utf-8'), score, tuple(box)) for name, score, box in out['result']]
+
+    def detect_image(self, data):
+        out = self.call('POST', '/detect', data, 'application/octet-stream')
+        return [(name.encode('utf-8'), score, tuple(box)) for name, score, box in out['result']]
+
+    def stats(self):
+        return self.call('GET', '/stats')
+
+if __name__ == "__main__":
+    import process_logging
+    process_logging.initLogging("/tmp/darknet_server.log")
+    parser = argparse.ArgumentParser()
+    parser.add_argument('vocData',help=('The voc.data of this model trained'))
+    parser.add_argument('--so', default='../libdarknet.so', help=('libdarknet.so to load'))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--unix', default=None, help=('Listen on this UNIX socket instead of TCP'))
+    parser.add_argument('--instances', type=int, default=1, help=('Warm networks, one batching thread each'))
+    parser.add_argument('--max-batch', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=5.)
+    args = parser.parse_args()
+
+    from darknet import darknet
+    instances = [darknet(args.vocData, soFile=args.so, batch=args.max_batch) for i in range(args.instances)]
+    batcher = MicroBatcher(instances, args.max_batch, args.max_wait_ms / 1000.)
+    server = make_server(batcher, args.unix or (args.host, args.port))
+    logger.info("darknet server on {0}".format(args.unix or (args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logger.info("stats:{0}".format(json.dumps(batcher.stats())))
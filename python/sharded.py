@@ -0,0 +1,121 @@
+import os
+import time
+import logging
+import multiprocessing
+from ctypes import CDLL, c_int
+
+logger = logging.getLogger(__name__)
+
+#thread pools that would otherwise each size themselves to every core
+THREAD_ENV = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+#(library file name prefix, its thread count setter)
+THREAD_SETTERS = [('libgomp', 'omp_set_num_threads'), ('libiomp', 'omp_set_num_threads'),
+                  ('libopenblas', 'openblas_set_num_threads'), ('libmkl_rt', 'MKL_Set_Num_Threads')]
+
+#the per-process network, set by init_worker
+worker = None
+
+def loaded_libraries():
+    """Paths of the shared libraries mapped into this process, Linux only"""
+    try:
+        with open('/proc/self/maps', 'r') as f:
+            return sorted(set(line.split()[-1] for line in f if '.so' in line and '/' in line))
+    except IOError:
+        return []
+
+def limit_threads(threads):
+    """Cap the thread pools of this process at threads.
+
+    The environment variables only reach libraries loaded from now on;
+    OpenBLAS, OpenMP and MKL read them once, when loaded, and a forked
+    worker inherits them already loaded through numpy and cv2. Those get
+    their own setters instead.
+    """
+    for k in THREAD_ENV:
+        os.environ[k] = str(threads)
+    import cv2
+    cv2.setNumThreads(threads)
+    for path in loaded_libraries():
+        name = os.path.basename(path)
+        for prefix, setter in THREAD_SETTERS:
+            if not name.startswith(prefix):
+                continue
+            try:
+                f = getattr(CDLL(path), setter)
+            except (OSError, AttributeError):
+                continue
+            f.argtypes = [c_int]
+            f.restype = None
+            f(threads)
+
+def init_worker(vocData, soFile, batch, threads, draw, nms_engine=None, thresh=.5, tile=None, overlap=.2):
+    global worker
+    from darknet import darknet
+    dn = darknet(vocData, soFile=soFile, batch=batch, nms_engine=nms_engine)
+    #after loading the network, so libdarknet's OpenMP is capped too
+    limit_threads(threads)
+    worker = (dn, draw, thresh, tile, overlap)
+
+def detect_files(files):
+    dn, draw, thresh, tile, overlap = worker
+    if tile:
+        #tiled results are in frame coordinates and never drawn
+        import cv2
+        return [(f, dn.detect_tiled(cv2.imread(f), tile, overlap, thresh=thresh)) for f in files]
+    ims = [dn.load_timed(f) for f in files]
+    if dn.batch > 1:
+        rs = dn.detect_batch(ims, thresh=thresh, draw=draw)
+    else:
+        rs = [dn.detect(im, thresh=thresh, draw=draw) for im in ims]
+    for f, im in zip(files, ims):
+        if draw:
+            dn.save_detected(im, f)
+        else:
+            dn.free_image(im)
+    return zip(files, rs)
+
+def list_images(path):
+    """JPEG files of a directory, or the images of a dataset manifest (scripts/voc_manifest.py)"""
+    if path.endswith('.npz'):
+        import numpy as np
+        f = np.load(path)
+        try:
+            return [str(p) for p in f['paths']]
+        finally:
+            f.close()
+    return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.lower().endswith('.jpg')]
+
+class ShardedRunner(object):
+    """Detect over many images with one network per worker process.
+
+    Every worker loads the network from the same voc.data once. Images
+    are handed out chunk files at a time from a shared queue, so faster
+    workers take more chunks, and results come back in input order.
+    threads caps the BLAS/OpenMP/OpenCV threads of each worker, keep
+    procs * threads at or below the core count. With tile, (w, h), each
+    image is detected in overlapping tiles as darknet.detect_tiled does.
+    """
+    def __init__(self, vocData, soFile='../libdarknet.so', procs=None, threads=1, batch=1, chunk=4, draw=False, nms_engine=None, thresh=.5, tile=None, overlap=.2):
+        self.procs = procs or max(1, multiprocessing.cpu_count() // threads)
+        self.chunk = max(chunk, batch)
+        self.pool = multiprocessing.Pool(self.procs, init_worker, (vocData, soFile, batch, threads, draw, nms_engine, thresh, tile, overlap))
+
+    def imap(self, images):
+        """Yield (imgfile, res) in input order; images is a list, a directory or a manifest."""
+        if isinstance(images, basestring):
+            images = list_images(images)
+        chunks = [images[i:i + self.chunk] for i in range(0, len(images), self.chunk)]
+        for results in self.pool.imap(detect_files, chunks):
+            for r in results:
+                yield r
+
+    def run(self, images):
+        t1 = time.time()
+        results = list(self.imap(images))
+        elapsed = time.time() - t1
+        logger.info("sharded: {0} images on {1} workers in {2:.2f}s".format(len(results), self.procs, elapsed))
+        return results
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,151 @@
+"""Streaming result sinks for the python runner.
+
+A sink takes detect() results as images finish, write(imgfile, res, w, h)
+with res a list or Detections and w x h the image size, and close() once
+at the end. Text sinks keep formatted lines and write them in bulk every
+flush_lines lines, so long runs cost one write per block, not per box.
+
+    jsonl   one JSON object per image: path, size and the detections in
+            the detect() (name, score, (x, y, w, h)) layout
+    comp4   the per class comp4_det_<set>_<class>.txt files `detector valid`
+            writes and scripts/reval_voc.py reads
+    coco    a COCO results JSON array, as `detector valid` with eval=coco
+    bin     the binary detection file of detfile.py, also read by reval_voc.py
+
+make_sink('kind:path', names) builds one from a command line spec.
+"""
+import os
+import re
+import json
+
+import numpy as np
+
+from detfile import DetectionFileWriter, image_id, result_columns, corner_boxes
+
+#category ids of the 80 coco.names classes, as coco_ids in examples/detector.c
+COCO_IDS = [1,2,3,4,5,6,7,8,9,10,11,13,14,15,16,17,18,19,20,21,22,23,24,25,27,28,31,32,33,34,35,36,37,38,39,40,41,42,43,44,46,47,48,49,50,51,52,53,54,55,56,57,58,59,60,61,62,63,64,65,67,70,72,73,74,75,76,77,78,79,80,81,82,84,85,86,87,88,89,90]
+
+COMP4_PREFIX = 'comp4_det_test_'
+
+def coco_image_id(imgfile):
+    """the number after the last '_' or '/', as get_coco_image_id"""
+    name = imgfile[max(imgfile.rfind('/'), imgfile.rfind('_')) + 1:]
+    m = re.match(r'\s*[-+]?\d+', name)
+    return int(m.group()) if m else 0
+
+class TextSink(object):
+    """Buffered text files; subclasses add lines with self.add(key, lines)."""
+    def __init__(self, names, flush_lines=4096):
+        self.names = list(names)
+        self.class_index = dict((name, i) for i, name in enumerate(self.names))
+        self.flush_lines = flush_lines
+        self.files = {}
+        self.pending = {}
+        self.count = 0
+
+    def open(self, key, path):
+        self.files[key] = open(path, 'w')
+        self.pending[key] = []
+
+    def add(self, key, lines):
+        self.pending[key].extend(lines)
+        self.count += len(lines)
+        if self.count >= self.flush_lines:
+            self.flush()
+
+    def flush(self):
+        for key, lines in self.pending.items():
+            if lines:
+                self.files[key].write(''.join(lines))
+                del lines[:]
+        self.count = 0
+
+    def close(self):
+        if self.files is None:
+            return
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = None
+
+class JsonLinesSink(TextSink):
+    def __init__(self, path, names, flush_lines=256):
+        TextSink.__init__(self, names, flush_lines)
+        self.open(0, path)
+
+    def write(self, imgfile, res, w, h):
+        class_ids, scores, x, y, bw, bh = result_columns(res, self.class_index)
+        dets = [{'name': self.names[c], 'score': float(s), 'box': [float(v) for v in (x[i], y[i], bw[i], bh[i])]}
+                for i, (c, s) in enumerate(zip(class_ids, scores))]
+        self.add(0, [json.dumps({'image': imgfile, 'width': w, 'height': h, 'detections': dets}) + '\n'])
+
+class Comp4Sink(TextSink):
+    """prefix + <class>.txt per class; a directory prefix gets COMP4_PREFIX"""
+    def __init__(self, prefix, names, flush_lines=4096):
+        TextSink.__init__(self, names, flush_lines)
+        if os.path.isdir(prefix) or prefix.endswith('/'):
+            prefix = os.path.join(prefix, COMP4_PREFIX)
+        directory = os.path.dirname(prefix)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        for k, name in enumerate(self.names):
+            self.open(k, prefix + name + '.txt')
+
+    def write(self, imgfile, res, w, h):
+        class_ids, scores, x, y, bw, bh = result_columns(res, self.class_index)
+        corners = corner_boxes(x, y, bw, bh, w, h)
+        iid = image_id(imgfile)
+        for i, c in enumerate(class_ids):
+            self.add(c, ['%s %f %f %f %f %f\n' % ((iid, scores[i]) + tuple(b[i] for b in corners))])
+
+class CocoSink(TextSink):
+    """One JSON array; category ids are COCO_IDS for 80 classes, else the class index."""
+    def __init__(self, path, names, flush_lines=4096):
+        TextSink.__init__(self, names, flush_lines)
+        self.open(0, path)
+        self.category_ids = COCO_IDS if len(self.names) == len(COCO_IDS) else range(len(self.names))
+        self.first = True
+        self.add(0, ['[\n'])
+
+    def write(self, imgfile, res, w, h):
+        class_ids, scores, x, y, bw, bh = result_columns(res, self.class_index)
+        #0-based corners clamped to the image, as print_cocos
+        xmin = np.maximum(x - bw / 2., 0).astype(np.float32)
+        ymin = np.maximum(y - bh / 2., 0).astype(np.float32)
+        xmax = np.minimum(x + bw / 2., w).astype(np.float32)
+        ymax = np.minimum(y + bh / 2., h).astype(np.float32)
+        iid = coco_image_id(imgfile)
+        lines = []
+        for i, c in enumerate(class_ids):
+            lines.append('%s{"image_id":%d, "category_id":%d, "bbox":[%f, %f, %f, %f], "score":%f}' % (
+                '' if self.first else ',\n', iid, self.category_ids[c],
+                xmin[i], ymin[i], xmax[i] - xmin[i], ymax[i] - ymin[i], scores[i]))
+            self.first = False
+        self.add(0, lines)
+
+    def close(self):
+        if self.files is not None:
+            self.add(0, ['\n]\n'])
+        TextSink.close(self)
+
+class Sinks(object):
+    """Several sinks fed as one"""
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, imgfile, res, w, h):
+        for sink in self.sinks:
+            sink.write(imgfile, res, w, h)
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+SINKS = {'jsonl': JsonLinesSink, 'comp4': Comp4Sink, 'coco': CocoSink, 'bin': DetectionFileWriter}
+
+def make_sink(spec, names):
+    """A sink from 'kind:path', kind one of SINKS"""
+    kind, sep, path = spec.partition(':')
+    if not sep or kind not in SINKS:
+        raise ValueError("bad sink {0}, expected <{1}>:<path>".format(spec, '|'.join(sorted(SINKS))))
+    return SINKS[kind](path, names)
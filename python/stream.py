@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+import Queue
+import collections
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#latency samples kept for the percentiles
+STATS_WINDOW = 10000
+
+class LatestFrame(object):
+    """Single-slot frame buffer: put() overwrites, get() waits for a newer frame."""
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.seq = 0
+        self.taken = 0
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self.cond:
+            if self.item is not None and self.taken < self.seq:
+                self.dropped += 1
+            self.item = item
+            self.seq += 1
+            self.cond.notify()
+
+    def get(self):
+        #None once closed and drained
+        with self.cond:
+            while self.taken == self.seq and not self.closed:
+                self.cond.wait(.1)
+            if self.taken == self.seq:
+                return None
+            self.taken = self.seq
+            return self.item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class RealtimeStream(object):
+    """Real-time detection that never falls behind its frame source.
+
+    A capture thread reads source (anything with a cv2.VideoCapture style
+    read() -> (ok, frame)) into a single-slot LatestFrame, the inference
+    thread always detects the newest frame so stale ones are dropped, and
+    callback(frame, res, latency) runs on a third thread. fps paces file
+    sources at their real frame rate.
+    """
+    def __init__(self, dn, source, callback=None, thresh=.5, hier_thresh=.5, nms=.45,
+            fps=None, result_depth=4):
+        self.dn = dn
+        self.source = source
+        self.callback = callback
+        self.thresh = thresh
+        self.hier_thresh = hier_thresh
+        self.nms = nms
+        self.fps = fps
+        self.slot = LatestFrame()
+        self.results = Queue.Queue(result_depth)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.captured = 0
+        self.processed = 0
+        self.dropped_results = 0
+        self.latencies = collections.deque(maxlen=STATS_WINDOW)
+        self.threads = []
+
+    def capture(self):
+        t0 = time.time()
+        try:
+            while not self.stopped.is_set():
+                ok, frame = self.source.read()
+                if not ok:
+                    break
+                if self.fps:
+                    delay = t0 + self.captured / float(self.fps) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.captured += 1
+                self.slot.put((time.time(), frame))
+        finally:
+            self.slot.close()
+
+    def infer(self):
+        try:
+            while True:
+                item = self.slot.get()
+                if item is None:
+                    return
+                stamp, frame = item
+                res = self.dn.detect_frame(frame, thresh=self.thresh, hier_thresh=self.hier_thresh,
+                        nms=self.nms)
+                self.processed += 1
+                try:
+                    self.results.put_nowait((stamp, frame, res))
+                except Queue.Full:
+                    self.dropped_results += 1
+        finally:
+            self.results.put(None)
+
+    def deliver(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            stamp, frame, res = item
+            try:
+                if self.callback:
+                    self.callback(frame, res, time.time() - stamp)
+            except Exception:
+                logger.exception("stream callback failed")
+            with self.lock:
+                self.latencies.append(time.time() - stamp)
+
+    def start(self):
+        for target in (self.capture, self.infer, self.deliver):
+            t = threading.Thread(target=target, name="stream-{0}".format(target.__name__))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def run(self):
+        """Process the whole source, blocking until it ends."""
+        self.start().join()
+        return self.stats()
+
+    def stats(self):
+        with self.lock:
+            lat = np.array(self.latencies) * 1000.
+        out = {'captured': self.captured,
+               'processed': self.processed,
+               'dropped': self.slot.dropped,
+               'dropped_results': self.dropped_results,
+               'latency_ms': {}}
+        if len(lat):
+            for p in (50, 95, 99):
+                out['latency_ms']['p{0}'.format(p)] = float(np.percentile(lat, p))
+            out['latency_ms']['max'] = float(lat.max())
+        return out
@@ -12,10 +12,12 @@
 """Reval = re-eval. Re-evaluate saved detections."""
 
 import os, sys, argparse
+import hashlib
+import multiprocessing
 import numpy as np
 import cPickle
 
-from voc_eval import voc_eval
+from voc_eval import voc_eval_table, load_annotations, is_detection_file, COCO_THRESHOLDS, AREA_RANGES
 
 def parse_args():
     """
@@ -28,6 +30,16 @@ def parse_args():
             help='VOCdevkit directory')
     parser.add_argument('--year', dest='year', default='2017', type=str)
     parser.add_argument('--image_set', dest='image_set', default='test', type=str)
+    parser.add_argument('--iou', dest='iou', default='0.5',
+            help='comma separated overlap thresholds, or coco for .5:.05:.95')
+    parser.add_argument('--areas', dest='areas', default='all',
+            help='comma separated area ranges out of ' + ', '.join(sorted(AREA_RANGES)))
+    parser.add_argument('--manifest', dest='manifest', default=None,
+            help='dataset manifest (voc_manifest.py) to read the ground truth from')
+    parser.add_argument('--jobs', dest='jobs', default=1, type=int,
+            help='processes evaluating classes in parallel')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+            help='re-evaluate every class even if its inputs did not change')
 
     ##parser.add_argument('--classes', dest='class_file', default='data/voc.names', type=str)
 
@@ -43,8 +55,43 @@ def get_voc_results_file_template(image_set, out_dir = 'results'):
     path = os.path.join(out_dir, filename)
     return path
 
-def do_python_eval(devkit_path, year, image_set, classes, output_dir = 'results'):
-    annopath = os.path.join(
+def get_voc_results_bin_file(image_set, out_dir = 'results'):
+    # written by `detector valid` with eval=vocbin
+    return os.path.join(out_dir, 'comp4_det_' + image_set + '.bin')
+
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def class_keys(detpath, classes, index, params):
+    """Cache key of each class: its detections, the ground truth index and
+    the evaluation parameters. A binary detection file is hashed whole."""
+    h = hashlib.sha1(params)
+    h.update(index.names.tostring())
+    h.update(index.stamps.tostring())
+    base = h.hexdigest()
+    shared = file_sha1(detpath) if is_detection_file(detpath) else None
+    keys = {}
+    for cls in classes:
+        h = hashlib.sha1(base + cls)
+        h.update(shared or file_sha1(detpath.format(cls)))
+        keys[cls] = h.hexdigest()
+    return keys
+
+def eval_classes(args):
+    """{cls: {(ovthresh, area): (rec, prec, ap)}} for a share of the classes"""
+    detpath, annopath, imagesetfile, classes, cachedir, ovthresholds, areas, use_07_metric = args
+    table = voc_eval_table(detpath, annopath, imagesetfile, classes, cachedir,
+                           ovthresholds, areas, use_07_metric)
+    return dict((cls, dict((k, v[cls]) for k, v in table.items())) for cls in classes)
+
+def do_python_eval(devkit_path, year, image_set, classes, output_dir = 'results',
+                   ovthresholds = (0.5,), areas = ('all',), jobs = 1, cache = True,
+                   manifest = None):
+    annopath = manifest or os.path.join(
         devkit_path,
         'Annotations',
         '{:s}.xml')
@@ -61,17 +108,69 @@ def do_python_eval(devkit_path, year, image_set, classes, output_dir = 'results'
     print 'VOC07 metric? ' + ('Yes' if use_07_metric else 'No')
     if not os.path.isdir(output_dir):
         os.mkdir(output_dir)
-    for i, cls in enumerate(classes):
-        if cls == '__background__':
-            continue
-        filename = get_voc_results_file_template(image_set).format(cls)
-        rec, prec, ap = voc_eval(
-            filename, annopath, imagesetfile, cls, cachedir, ovthresh=0.5,
-            use_07_metric=use_07_metric)
+    classes = [cls for cls in classes if cls != '__background__']
+    detpath = get_voc_results_bin_file(image_set)
+    if not os.path.isfile(detpath):
+        detpath = get_voc_results_file_template(image_set)
+
+    # refresh the annotation index once, before any worker reads it
+    index = load_annotations(annopath, imagesetfile, cachedir)
+    params = repr((list(ovthresholds), list(areas), use_07_metric))
+    keys = class_keys(detpath, classes, index, params)
+    resultdir = os.path.join(output_dir, 'reval_cache')
+    if not os.path.isdir(resultdir):
+        os.mkdir(resultdir)
+
+    per_class = {}
+    todo = []
+    for cls in classes:
+        cachefile = os.path.join(resultdir, keys[cls] + '.pkl')
+        if cache and os.path.isfile(cachefile):
+            with open(cachefile, 'rb') as f:
+                per_class[cls] = cPickle.load(f)
+        else:
+            todo.append(cls)
+    print 'Evaluating {0} classes, {1} unchanged'.format(len(todo), len(classes) - len(todo))
+
+    jobs = max(1, min(jobs, len(todo)))
+    shares = [(detpath, annopath, imagesetfile, todo[i::jobs], cachedir, ovthresholds, areas, use_07_metric)
+              for i in range(jobs)]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        done = pool.map(eval_classes, shares)
+        pool.close()
+        pool.join()
+    else:
+        done = [eval_classes(share) for share in shares if share[3]]
+    for result in done:
+        for cls, entry in result.items():
+            per_class[cls] = entry
+            with open(os.path.join(resultdir, keys[cls] + '.pkl'), 'wb') as f:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+
+    table = {}
+    for cls in classes:
+        for k, v in per_class[cls].items():
+            table.setdefault(k, {})[cls] = v
+    # per class output for the first threshold and area
+    results = table[(ovthresholds[0], areas[0])]
+    # keys of the results the <cls>_pr.pkl files hold, only changed ones are rewritten
+    writtenfile = os.path.join(resultdir, 'written.pkl')
+    written = {}
+    if os.path.isfile(writtenfile):
+        with open(writtenfile, 'rb') as f:
+            written = cPickle.load(f)
+    for cls in classes:
+        rec, prec, ap = results[cls]
         aps += [ap]
         print('AP for {} = {:.4f}'.format(cls, ap))
-        with open(os.path.join(output_dir, cls + '_pr.pkl'), 'w') as f:
-            cPickle.dump({'rec': rec, 'prec': prec, 'ap': ap}, f)
+        prfile = os.path.join(output_dir, cls + '_pr.pkl')
+        if written.get(cls) != keys[cls] or not os.path.isfile(prfile):
+            with open(prfile, 'w') as f:
+                cPickle.dump({'rec': rec, 'prec': prec, 'ap': ap}, f)
+            written[cls] = keys[cls]
+    with open(writtenfile, 'wb') as f:
+        cPickle.dump(written, f, cPickle.HIGHEST_PROTOCOL)
     print('Mean AP = {:.4f}'.format(np.mean(aps)))
     print('~~~~~~~~')
     print('Results:')
@@ -79,6 +178,8 @@ def do_python_eval(devkit_path, year, image_set, classes, output_dir = 'results'
         print('{:.3f}'.format(ap))
     print('{:.3f}'.format(np.mean(aps)))
     print('~~~~~~~~')
+    if len(ovthresholds) > 1 or len(areas) > 1:
+        print_table(table, classes, ovthresholds, areas)
     print('')
     print('--------------------------------------------------------------')
     print('Results computed with the **unofficial** Python eval code.')
@@ -87,6 +188,14 @@ def do_python_eval(devkit_path, year, image_set, classes, output_dir = 'results'
     print('--------------------------------------------------------------')
 
 
+def print_table(table, classes, ovthresholds, areas):
+    print('Mean AP by area range and overlap threshold:')
+    print('{:8s}'.format('area') + ''.join('{:>7.2f}'.format(t) for t in ovthresholds) + '{:>8s}'.format('mean'))
+    for area in areas:
+        maps = [np.mean([table[(t, area)][cls][2] for cls in classes]) for t in ovthresholds]
+        print('{:8s}'.format(area) + ''.join('{:7.3f}'.format(m) for m in maps) + '{:8.3f}'.format(np.mean(maps)))
+    print('~~~~~~~~')
+
 
 if __name__ == '__main__':
     args = parse_args()
@@ -99,4 +208,10 @@ if __name__ == '__main__':
     classes = [t.strip('\n') for t in lines]
 
     print 'Evaluating detections'
-    do_python_eval(args.voc_dir, args.year, args.image_set, classes, output_dir)
+    if args.iou == 'coco':
+        ovthresholds = COCO_THRESHOLDS
+    else:
+        ovthresholds = [float(t) for t in args.iou.split(',')]
+    do_python_eval(args.voc_dir, args.year, args.image_set, classes, output_dir,
+                   ovthresholds, args.areas.split(','), args.jobs, args.cache,
+                   args.manifest)
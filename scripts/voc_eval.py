@@ -6,28 +6,16 @@
 # Written by Bharath Hariharan
 # --------------------------------------------------------
 
-import xml.etree.ElementTree as ET
 import os,sys
-import cPickle
+import hashlib
 import numpy as np
 
-def parse_rec(filename):
-    """ Parse a PASCAL VOC xml file """
-    tree = ET.parse(filename)
-    objects = []
-    for obj in tree.findall('object'):
-        obj_struct = {}
-        obj_struct['name'] = obj.find('name').text
-        #obj_struct['pose'] = obj.find('pose').text
-        #obj_struct['truncated'] = int(obj.find('truncated').text)
-        obj_struct['difficult'] = int(obj.find('difficult').text)
-        bbox = obj.find('bndbox')
-        obj_struct['bbox'] = [int(bbox.find('xmin').text),
-                              int(bbox.find('ymin').text),
-                              int(bbox.find('xmax').text),
-                              int(bbox.find('ymax').text)]
-        objects.append(obj_struct)
-    return objects
+from voc_manifest import Manifest, update_manifest
+
+# the binary detection file of `detector valid` with eval=vocbin is defined
+# once, in python/detfile.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from detfile import is_detection_file, read_detection_file
 
 def voc_ap(rec, prec, use_07_metric=False):
     """ ap = voc_ap(rec, prec, [use_07_metric])
@@ -51,8 +39,7 @@ def voc_ap(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -62,6 +49,297 @@ def voc_ap(rec, prec, use_07_metric=False):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+class AnnotationIndex(object):
+    """The annotations of an image set, read out of a dataset manifest
+    (voc_manifest.py) in image set order.
+
+    The objects of image names[i] are rows offsets[i]:offsets[i + 1] of
+    label (an index into labels), bbox and difficult. stamps holds the
+    (mtime, size) each annotation file had when it was parsed.
+    """
+    def __init__(self, manifest, names):
+        rows = manifest.select(names)
+        counts = np.diff(manifest.offsets)[rows]
+        self.names = np.array(names, dtype=np.str_).reshape(-1)
+        self.stamps = manifest.stamps[rows].reshape(-1, 2)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        objs = np.repeat(manifest.offsets[rows] - self.offsets[:-1], counts) + np.arange(self.offsets[-1])
+        self.labels = manifest.labels
+        self.label = manifest.label[objs]
+        self.bbox = manifest.bbox[objs]
+        self.difficult = manifest.difficult[objs]
+
+def annotation_manifest(annopath, imagenames, cachedir):
+    """The manifest of annopath.format(imagename) for imagenames, kept in
+    cachedir; images of earlier image sets stay in it."""
+    if not os.path.isdir(cachedir):
+        os.mkdir(cachedir)
+    path = os.path.join(cachedir, 'manifest-{0}.npz'.format(hashlib.sha1(annopath).hexdigest()[:16]))
+    images = []
+    seen = set()
+    for imagename in imagenames:
+        if imagename in seen:
+            continue
+        seen.add(imagename)
+        annotation = os.path.abspath(annopath.format(imagename))
+        # devkit layout: JPEGImages/ next to Annotations/
+        image = os.path.join(os.path.dirname(os.path.dirname(annotation)), 'JPEGImages', imagename + '.jpg')
+        images.append((imagename, annotation, image))
+    manifest, parsed = update_manifest(path, images)
+    if parsed:
+        print 'Saving cached annotations to {:s} ({:d} parsed)'.format(path, parsed)
+    return manifest
+
+def load_annotations(annopath, imagesetfile, cachedir):
+    """AnnotationIndex of the images in imagesetfile.
+
+    An annopath ending in .npz is a dataset manifest and is read as is;
+    otherwise the manifest of the XML files is kept in cachedir and only
+    the files that changed since it was written are parsed again.
+    """
+    # read list of images
+    with open(imagesetfile, 'r') as f:
+        lines = f.readlines()
+    imagenames = [x.strip() for x in lines]
+    if annopath.endswith('.npz'):
+        manifest = Manifest.load(annopath)
+    else:
+        manifest = annotation_manifest(annopath, imagenames, cachedir)
+    return AnnotationIndex(manifest, imagenames)
+
+class GroundTruth(object):
+    """Ground truth of an image set for a list of classes, as flat arrays.
+
+    Boxes are sorted by (class, image) and keep their annotation order
+    inside each image, so the boxes of one class in one image form the
+    contiguous segment returned by segments().
+    """
+    def __init__(self, index, classnames):
+        self.imagenames = list(index.names)
+        self.classnames = classnames
+        self.image_index = dict((name, i) for i, name in enumerate(self.imagenames))
+        class_index = dict((name, c) for c, name in enumerate(classnames))
+        label_class = np.array([class_index.get(x, -1) for x in index.labels], dtype=int)
+        cls = label_class[index.label] if len(index.label) else np.zeros(0, dtype=int)
+        image = np.repeat(np.arange(len(self.imagenames)), np.diff(index.offsets))
+        keep = cls >= 0
+        cls = cls[keep]
+        key = cls * len(self.imagenames) + image[keep]
+        order = np.argsort(key, kind='mergesort')
+        self.key = key[order]
+        self.cls = cls[order]
+        self.difficult = index.difficult[keep][order]
+        self.bbox = index.bbox[keep][order].astype(float)
+        self.npos = np.bincount(self.cls[~self.difficult], minlength=len(classnames))
+
+    def segments(self, cls, images):
+        """start and count of the boxes of class cls[k] in image images[k]"""
+        keys = cls * len(self.imagenames) + images
+        start = np.searchsorted(self.key, keys, 'left')
+        count = np.searchsorted(self.key, keys, 'right') - start
+        return start, count
+
+def read_detections(detpath, classname):
+    """image_ids, confidence, BB of detpath.format(classname)"""
+    detfile = detpath.format(classname)
+    with open(detfile, 'r') as f:
+        lines = f.readlines()
+
+    splitlines = [x.strip().split(' ') for x in lines]
+    image_ids = [x[0] for x in splitlines]
+    confidence = np.array([float(x[1]) for x in splitlines])
+    BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
+    return image_ids, confidence, BB
+
+def class_detections(detpath, gt):
+    """Yield images, confidence, BB of each class of gt, in file order.
+
+    detpath is a binary detection file holding every class, or the
+    detpath.format(classname) template of the per-class text files.
+    """
+    if is_detection_file(detpath):
+        image_ids, labels, records = read_detection_file(detpath)
+        image_map = np.array([gt.image_index.get(x, -1) for x in image_ids], dtype=int)
+        class_map = np.array([gt.classnames.index(x) if x in gt.classnames else -1 for x in labels], dtype=int)
+        cls = class_map[records['class_id']]
+        order = np.argsort(cls, kind='mergesort')
+        ends = np.searchsorted(cls[order], np.arange(len(gt.classnames) + 1))
+        for c in range(len(gt.classnames)):
+            sel = records[order[ends[c]:ends[c + 1]]]
+            images = image_map[sel['image']]
+            if (images < 0).any():
+                raise KeyError(image_ids[sel['image'][images < 0][0]])
+            BB = np.column_stack([sel['xmin'], sel['ymin'], sel['xmax'], sel['ymax']])
+            yield images, sel['score'].astype(float), BB.astype(float)
+    else:
+        for classname in gt.classnames:
+            image_ids, confidence, BB = read_detections(detpath, classname)
+            images = np.array([gt.image_index[x] for x in image_ids], dtype=int)
+            yield images, confidence, BB
+
+def match_detections(gt, cls, images, BB):
+    """ovmax, jmax = match_detections(gt, cls, images, BB)
+    Best overlap of each detection with the ground truth of its class and
+    image, and the index of that ground truth box in gt (first one on
+    ties, -1 if there is none). All detections are handled at once over
+    the flattened (detection, candidate box) pairs.
+    """
+    nd = len(cls)
+    ovmax = np.full(nd, -np.inf)
+    jmax = np.full(nd, -1, dtype=int)
+    start, count = gt.segments(cls, images)
+    npairs = count.sum()
+    if npairs == 0:
+        return ovmax, jmax
+
+    first = np.cumsum(count) - count
+    det = np.repeat(np.arange(nd), count)
+    j = np.repeat(start, count) + np.arange(npairs) - np.repeat(first, count)
+    bb = BB[det]
+    BBGT = gt.bbox[j]
+
+    # intersection
+    ixmin = np.maximum(BBGT[:, 0], bb[:, 0])
+    iymin = np.maximum(BBGT[:, 1], bb[:, 1])
+    ixmax = np.minimum(BBGT[:, 2], bb[:, 2])
+    iymax = np.minimum(BBGT[:, 3], bb[:, 3])
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
+
+    # union
+    uni = ((bb[:, 2] - bb[:, 0] + 1.) * (bb[:, 3] - bb[:, 1] + 1.) +
+           (BBGT[:, 2] - BBGT[:, 0] + 1.) *
+           (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
+    overlaps = inters / uni
+
+    has = count > 0
+    ovmax[has] = np.maximum.reduceat(overlaps, first[has])
+    best = overlaps == ovmax[det]
+    d, k = np.unique(det[best], return_index=True)
+    jmax[d] = j[best][k]
+    return ovmax, jmax
+
+# COCO mAP@[.5:.95] overlap thresholds and box area ranges
+COCO_THRESHOLDS = [round(.5 + .05 * i, 2) for i in range(10)]
+AREA_RANGES = {'all': (0, 1e10),
+               'small': (0, 32 ** 2),
+               'medium': (32 ** 2, 96 ** 2),
+               'large': (96 ** 2, 1e10)}
+
+def box_area(BB):
+    return (BB[:, 2] - BB[:, 0] + 1.) * (BB[:, 3] - BB[:, 1] + 1.)
+
+def greedy_match(ovmax, jmax, ovthresh, ignore, det_ignore=None):
+    """tp, fp = greedy_match(ovmax, jmax, ovthresh, ignore, [det_ignore])
+    VOC matching for detections already sorted by confidence within each
+    class: the first detection to hit a box is a TP, later ones are FPs,
+    and hits on ignored (difficult) boxes count as neither. FPs flagged in
+    det_ignore are dropped too.
+    """
+    nd = len(ovmax)
+    matched = ovmax > ovthresh
+    skipped = np.zeros(nd, dtype=np.bool)
+    skipped[matched] = ignore[jmax[matched]]
+    hits = np.nonzero(matched & ~skipped)[0]
+    _, first = np.unique(jmax[hits], return_index=True)
+    tp = np.zeros(nd)
+    fp = np.zeros(nd)
+    fp[~matched] = 1.
+    fp[hits] = 1.
+    fp[hits[first]] = 0.
+    tp[hits[first]] = 1.
+    if det_ignore is not None:
+        fp[det_ignore] = 0.
+    return tp, fp
+
+def voc_eval_table(detpath,
+                   annopath,
+                   imagesetfile,
+                   classnames,
+                   cachedir,
+                   ovthresholds=(0.5,),
+                   areas=('all',),
+                   use_07_metric=False):
+    """{(ovthresh, area): {classname: (rec, prec, ap)}} = voc_eval_table(...)
+    voc_eval for every class, overlap threshold and area range in one pass.
+
+    The ground truth is loaded once, the detections of all classes are
+    matched together, and the overlaps are computed once and reused for
+    every threshold: only the TP/FP assignment is redone per threshold.
+    areas name AREA_RANGES; outside of 'all', ground truth boxes outside
+    the range are ignored like difficult ones and so are the false
+    positives outside of it, as in the COCO evaluation.
+    """
+    gt = GroundTruth(load_annotations(annopath, imagesetfile, cachedir), classnames)
+
+    # read dets, sorted by confidence within each class
+    cls = []
+    images = []
+    boxes = []
+    for c, (image, confidence, BB) in enumerate(class_detections(detpath, gt)):
+        sorted_ind = np.argsort(-confidence)
+        cls.append(np.full(len(sorted_ind), c, dtype=int))
+        images.append(image[sorted_ind])
+        boxes.append(BB[sorted_ind, :])
+    ends = np.cumsum([len(x) for x in cls])
+    cls = np.concatenate(cls)
+    images = np.concatenate(images)
+    BB = np.concatenate(boxes).astype(float)
+
+    ovmax, jmax = match_detections(gt, cls, images, BB)
+
+    table = {}
+    for area in areas:
+        if area == 'all':
+            ignore = gt.difficult
+            det_ignore = None
+            npos = gt.npos
+        else:
+            lo, hi = AREA_RANGES[area]
+            gt_area = box_area(gt.bbox)
+            ignore = gt.difficult | (gt_area < lo) | (gt_area > hi)
+            det_area = box_area(BB)
+            det_ignore = (det_area < lo) | (det_area > hi)
+            npos = np.bincount(gt.cls[~ignore], minlength=len(classnames))
+        for ovthresh in ovthresholds:
+            # go down dets and mark TPs and FPs
+            tp, fp = greedy_match(ovmax, jmax, ovthresh, ignore, det_ignore)
+            results = {}
+            for c, classname in enumerate(classnames):
+                s = slice(ends[c - 1] if c else 0, ends[c])
+                # compute precision recall
+                cfp = np.cumsum(fp[s])
+                ctp = np.cumsum(tp[s])
+                rec = ctp / float(npos[c])
+                # avoid divide by zero in case the first detection matches a difficult
+                # ground truth
+                prec = ctp / np.maximum(ctp + cfp, np.finfo(np.float64).eps)
+                ap = voc_ap(rec, prec, use_07_metric)
+                results[classname] = (rec, prec, ap)
+            table[(ovthresh, area)] = results
+    return table
+
+def voc_eval_all(detpath,
+                 annopath,
+                 imagesetfile,
+                 classnames,
+                 cachedir,
+                 ovthresh=0.5,
+                 use_07_metric=False):
+    """{classname: (rec, prec, ap)} = voc_eval_all(detpath,
+                                annopath,
+                                imagesetfile,
+                                classnames,
+                                cachedir,
+                                [ovthresh],
+                                [use_07_metric])
+    voc_eval for every class of classnames in one pass: the ground truth
+    is loaded once and the detections of all classes are matched together.
+    """
+    return voc_eval_table(detpath, annopath, imagesetfile, classnames, cachedir,
+                          [ovthresh], ['all'], use_07_metric)[(ovthresh, 'all')]
+
 def voc_eval(detpath,
              annopath,
              imagesetfile,
@@ -77,9 +355,11 @@ def voc_eval(detpath,
                                 [use_07_metric])
     Top level function that does the PASCAL VOC evaluation.
     detpath: Path to detections
-        detpath.format(classname) should produce the detection results file.
+        detpath.format(classname) should produce the detection results file,
+        or detpath is a binary detection file holding every class.
     annopath: Path to annotations
-        annopath.format(imagename) should be the xml annotations file.
+        annopath.format(imagename) should be the xml annotations file,
+        or annopath is a dataset manifest .npz built by voc_manifest.py.
     imagesetfile: Text file containing the list of images, one image per line.
     classname: Category name (duh)
     cachedir: Directory for caching the annotations
@@ -90,112 +370,6 @@ def voc_eval(detpath,
     # assumes detections are in detpath.format(classname)
     # assumes annotations are in annopath.format(imagename)
     # assumes imagesetfile is a text file with each line an image name
-    # cachedir caches the annotations in a pickle file
-
-    # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, 'annots.pkl')
-    # read list of images
-    with open(imagesetfile, 'r') as f:
-        lines = f.readlines()
-    imagenames = [x.strip() for x in lines]
-
-    if not os.path.isfile(cachefile):
-        # load annots
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath.format(imagename))
-            if i % 100 == 0:
-                #print 'Reading annotation for {:d}/{:d}'.format(
-                    #i + 1, len(imagenames))
-                sys.stdout.write('Reading annotation for: {0}/{1}\r'.format(i + 1, len(imagenames)))
-                sys.stdout.flush()
-        # save
-        print 'Saving cached annotations to {:s}'.format(cachefile)
-        with open(cachefile, 'w') as f:
-            cPickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'r') as f:
-            recs = cPickle.load(f)
-
-    # extract gt objects for this class
-    class_recs = {}
-    npos = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj['name'] == classname]
-        bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        class_recs[imagename] = {'bbox': bbox,
-                                 'difficult': difficult,
-                                 'det': det}
-
-    # read dets
-    detfile = detpath.format(classname)
-    with open(detfile, 'r') as f:
-        lines = f.readlines()
-
-    splitlines = [x.strip().split(' ') for x in lines]
-    image_ids = [x[0] for x in splitlines]
-    confidence = np.array([float(x[1]) for x in splitlines])
-    BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
-
-    # sort by confidence
-    sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
-    BB = BB[sorted_ind, :]
-    image_ids = [image_ids[x] for x in sorted_ind]
-
-    # go down dets and mark TPs and FPs
-    nd = len(image_ids)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
-    for d in range(nd):
-        R = class_recs[image_ids[d]]
-        bb = BB[d, :].astype(float)
-        ovmax = -np.inf
-        BBGT = R['bbox'].astype(float)
-
-        if BBGT.size > 0:
-            # compute overlaps
-            # intersection
-            ixmin = np.maximum(BBGT[:, 0], bb[0])
-            iymin = np.maximum(BBGT[:, 1], bb[1])
-            ixmax = np.minimum(BBGT[:, 2], bb[2])
-            iymax = np.minimum(BBGT[:, 3], bb[3])
-            iw = np.maximum(ixmax - ixmin + 1., 0.)
-            ih = np.maximum(iymax - iymin + 1., 0.)
-            inters = iw * ih
-
-            # union
-            uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-                   (BBGT[:, 2] - BBGT[:, 0] + 1.) *
-                   (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
-
-            overlaps = inters / uni
-            ovmax = np.max(overlaps)
-            jmax = np.argmax(overlaps)
-
-        if ovmax > ovthresh:
-            if not R['difficult'][jmax]:
-                if not R['det'][jmax]:
-                    tp[d] = 1.
-                    R['det'][jmax] = 1
-                else:
-                    fp[d] = 1.
-        else:
-            fp[d] = 1.
-
-    # compute precision recall
-    fp = np.cumsum(fp)
-    tp = np.cumsum(tp)
-    rec = tp / float(npos)
-    # avoid divide by zero in case the first detection matches a difficult
-    # ground truth
-    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-    ap = voc_ap(rec, prec, use_07_metric)
-
-    return rec, prec, ap
+    # cachedir keeps the manifest of the annotations
+    return voc_eval_all(detpath, annopath, imagesetfile, [classname], cachedir,
+                        ovthresh, use_07_metric)[classname]
@@ -1,13 +1,17 @@
-import xml.etree.ElementTree as ET
-import pickle
 import os
-from os import listdir, getcwd
+import argparse
+from os import getcwd
 from os.path import join
 
+from voc_manifest import build_manifest, read_image_ids
+
 sets=[('2012', 'train'), ('2012', 'val'), ('2007', 'train'), ('2007', 'val'), ('2007', 'test')]
 
 classes = ["aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow", "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train", "tvmonitor"]
 
+# class list of a year's labels; rewritten when it changes, so labels older
+# than it are redone
+CLASSES_STAMP = '.classes'
 
 def convert(size, box):
     dw = 1./(size[0])
@@ -22,38 +26,102 @@ def convert(size, box):
     h = h*dh
     return (x,y,w,h)
 
-def convert_annotation(year, image_id):
-    in_file = open('VOCdevkit/VOC%s/Annotations/%s.xml'%(year, image_id))
-    out_file = open('VOCdevkit/VOC%s/labels/%s.txt'%(year, image_id), 'w')
-    tree=ET.parse(in_file)
-    root = tree.getroot()
-    size = root.find('size')
-    w = int(size.find('width').text)
-    h = int(size.find('height').text)
-
-    for obj in root.iter('object'):
-        difficult = obj.find('difficult').text
-        cls = obj.find('name').text
-        if cls not in classes or int(difficult)==1:
+def convert_annotation(manifest, i, classes, out_path):
+    """Write the label file of manifest row i"""
+    w, h = [int(v) for v in manifest.sizes[i]]
+    label, bbox, difficult = manifest.objects(i)
+    lines = []
+    for k in range(len(label)):
+        cls = manifest.labels[label[k]]
+        if cls not in classes or difficult[k]:
             continue
         cls_id = classes.index(cls)
-        xmlbox = obj.find('bndbox')
-        b = (float(xmlbox.find('xmin').text), float(xmlbox.find('xmax').text), float(xmlbox.find('ymin').text), float(xmlbox.find('ymax').text))
-        bb = convert((w,h), b)
-        out_file.write(str(cls_id) + " " + " ".join([str(a) for a in bb]) + '\n')
-
-wd = getcwd()
-
-for year, image_set in sets:
-    if not os.path.exists('VOCdevkit/VOC%s/labels/'%(year)):
-        os.makedirs('VOCdevkit/VOC%s/labels/'%(year))
-    image_ids = open('VOCdevkit/VOC%s/ImageSets/Main/%s.txt'%(year, image_set)).read().strip().split()
-    list_file = open('%s_%s.txt'%(year, image_set), 'w')
-    for image_id in image_ids:
-        list_file.write('%s/VOCdevkit/VOC%s/JPEGImages/%s.jpg\n'%(wd, year, image_id))
-        convert_annotation(year, image_id)
-    list_file.close()
-
-os.system("cat 2007_train.txt 2007_val.txt 2012_train.txt 2012_val.txt > train.txt")
-os.system("cat 2007_train.txt 2007_val.txt 2007_test.txt 2012_train.txt 2012_val.txt > train.all.txt")
+        xmin, ymin, xmax, ymax = [float(v) for v in bbox[k]]
+        bb = convert((w,h), (xmin, xmax, ymin, ymax))
+        lines.append(str(cls_id) + " " + " ".join([str(a) for a in bb]) + '\n')
+    tmp = out_path + '.tmp'
+    with open(tmp, 'w') as out_file:
+        out_file.writelines(lines)
+    os.rename(tmp, out_path)
+
+def classes_stamp(devkit, year, classes):
+    """mtime of the year's class list stamp, rewritten first if classes changed"""
+    stamp = join(devkit, 'VOC%s/labels/%s'%(year, CLASSES_STAMP))
+    text = '\n'.join(classes) + '\n'
+    if os.path.exists(stamp):
+        with open(stamp) as f:
+            if f.read() == text:
+                return os.path.getmtime(stamp)
+    with open(stamp, 'w') as f:
+        f.write(text)
+    return os.path.getmtime(stamp)
+
+def write_lists(sets, devkit, list_dir):
+    """<year>_<set>.txt per set, streamed into train.txt (all but test sets)
+    and train.all.txt, ordered by year."""
+    root = os.path.abspath(devkit)
+    train = open(join(list_dir, 'train.txt'), 'w')
+    train_all = open(join(list_dir, 'train.all.txt'), 'w')
+    for year, image_set in sorted(sets, key=lambda s: s[0]):
+        with open(join(list_dir, '%s_%s.txt'%(year, image_set)), 'w') as list_file:
+            for image_id in read_image_ids(devkit, year, image_set):
+                line = '%s/VOC%s/JPEGImages/%s.jpg\n'%(root, year, image_id)
+                list_file.write(line)
+                train_all.write(line)
+                if image_set != 'test':
+                    train.write(line)
+    train.close()
+    train_all.close()
+
+def label(sets, classes, devkit='VOCdevkit', list_dir='.', jobs=None, force=False, manifest_path=None):
+    """Labels and image lists of sets from the dataset manifest, which is
+    brought up to date first. A label file is rewritten when it is older
+    than its xml or than the year's class list stamp."""
+    manifest, parsed = build_manifest(devkit, sets, manifest_path, jobs)
+    converted = 0
+    total = 0
+    for year in sorted(set(year for year, image_set in sets)):
+        if not os.path.exists(join(devkit, 'VOC%s/labels/'%(year))):
+            os.makedirs(join(devkit, 'VOC%s/labels/'%(year)))
+        since = classes_stamp(devkit, year, classes)
+        seen = set()
+        for y, image_set in sets:
+            if y != year:
+                continue
+            for image_id in read_image_ids(devkit, year, image_set):
+                if image_id in seen:
+                    continue
+                seen.add(image_id)
+                i = manifest.index[image_id]
+                out_path = join(devkit, 'VOC%s/labels/%s.txt'%(year, image_id))
+                if force or not os.path.exists(out_path) or \
+                        os.path.getmtime(out_path) < max(since, manifest.stamps[i, 0]):
+                    convert_annotation(manifest, i, classes, out_path)
+                    converted += 1
+        total += len(seen)
+    print '%d annotations parsed, %d labels written, %d up to date'%(parsed, converted, total - converted)
+
+    write_lists(sets, devkit, list_dir)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert VOC annotations to darknet labels and image lists')
+    parser.add_argument('--devkit', default='VOCdevkit', help='VOCdevkit directory')
+    parser.add_argument('--sets', default=','.join('%s_%s'%s for s in sets),
+            help='comma separated <year>_<image set> list')
+    parser.add_argument('--classes', default=','.join(classes),
+            help='comma separated class names, or a .names file')
+    parser.add_argument('--list-dir', default=getcwd(), help='where the image lists go')
+    parser.add_argument('--manifest', default=None, help='dataset manifest, <devkit>/manifest.npz by default')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='processes parsing annotations, all cores by default')
+    parser.add_argument('-f', '--force', action='store_true', help='rewrite labels that are up to date')
+    return parser.parse_args()
 
+if __name__ == '__main__':
+    args = parse_args()
+    if os.path.isfile(args.classes):
+        with open(args.classes) as f:
+            names = [line.strip() for line in f if line.strip()]
+    else:
+        names = args.classes.split(',')
+    label([tuple(s.split('_', 1)) for s in args.sets.split(',')], names,
+          args.devkit, args.list_dir, args.jobs, args.force, args.manifest)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+"""Dataset manifest: one index of a VOC devkit for every consumer.
+
+voc_label.py writes labels from it, voc_eval.py reads the ground truth
+from it (given as annopath, any path ending in .npz, or kept in its cache
+directory for an XML annopath), and darknet.py -p accepts it in place of
+an image directory. It is built from the image sets'
+annotation XML once, then updated incrementally: only the XML files whose
+(mtime, size) changed are parsed again.
+
+Columns, saved as an uncompressed .npz:
+    ids, paths      image id and absolute JPEG path of each image
+    sizes           (width, height) from the annotation
+    stamps          (mtime, size) of the annotation file when parsed
+    offsets         objects of image i are rows offsets[i]:offsets[i + 1]
+    labels          class names, label indexes them
+    label, bbox, difficult
+                    per object; bbox is (xmin, ymin, xmax, ymax)
+"""
+import xml.etree.ElementTree as ET
+import os
+import zipfile
+import argparse
+import multiprocessing
+from os.path import join
+
+import numpy as np
+
+def read_image_ids(devkit, year, image_set):
+    with open(join(devkit, 'VOC%s/ImageSets/Main/%s.txt'%(year, image_set))) as f:
+        return f.read().strip().split()
+
+def annotation_path(devkit, year, image_id):
+    return join(devkit, 'VOC%s/Annotations/%s.xml'%(year, image_id))
+
+def parse_annotation(filename):
+    """(w, h), [(name, difficult, (xmin, ymin, xmax, ymax))] of a VOC xml,
+    parsed element by element and freed as it goes."""
+    size = (0, 0)
+    objects = []
+    for event, elem in ET.iterparse(filename):
+        if elem.tag == 'size':
+            size = (int(elem.find('width').text), int(elem.find('height').text))
+            elem.clear()
+        elif elem.tag == 'object':
+            bndbox = elem.find('bndbox')
+            b = tuple(float(bndbox.find(k).text) for k in ('xmin', 'ymin', 'xmax', 'ymax'))
+            objects.append((elem.find('name').text, int(elem.find('difficult').text), b))
+            elem.clear()
+    return size, objects
+
+class Manifest(object):
+    COLUMNS = ('ids', 'paths', 'sizes', 'stamps', 'offsets', 'labels', 'label', 'bbox', 'difficult')
+
+    def __init__(self, ids, paths, sizes, stamps, offsets, labels, label, bbox, difficult):
+        self.ids = ids
+        self.paths = paths
+        self.sizes = sizes
+        self.stamps = stamps
+        self.offsets = offsets
+        self.labels = labels
+        self.label = label
+        self.bbox = bbox
+        self.difficult = difficult
+        self.index = dict((x, i) for i, x in enumerate(ids))
+
+    @classmethod
+    def load(cls, path):
+        f = np.load(path)
+        try:
+            return cls(**dict((k, f[k]) for k in cls.COLUMNS))
+        finally:
+            f.close()
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, **dict((k, getattr(self, k)) for k in self.COLUMNS))
+        os.rename(tmp, path)
+
+    def objects(self, i):
+        s = slice(self.offsets[i], self.offsets[i + 1])
+        return self.label[s], self.bbox[s], self.difficult[s]
+
+    def select(self, ids):
+        """row of each image id; KeyError for ids not in the manifest"""
+        return np.array([self.index[x] for x in ids], dtype=np.int64)
+
+def load_manifest(path):
+    try:
+        return Manifest.load(path)
+    except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+        return None
+
+def build_manifest(devkit, sets, path=None, jobs=None):
+    """Update the manifest at path with the images of sets, [(year, image_set)].
+    Images it already holds from other sets are kept. Returns the manifest
+    and the number of annotation files parsed."""
+    path = path or join(devkit, 'manifest.npz')
+    root = os.path.abspath(devkit)
+    images = []
+    seen = set()
+    for year, image_set in sets:
+        for image_id in read_image_ids(devkit, year, image_set):
+            if image_id not in seen:
+                seen.add(image_id)
+                images.append((image_id, annotation_path(devkit, year, image_id),
+                               '%s/VOC%s/JPEGImages/%s.jpg'%(root, year, image_id)))
+    return update_manifest(path, images, jobs)
+
+def update_manifest(path, images, jobs=None):
+    """Update the manifest at path with images, [(image_id, annotation file,
+    JPEG path)] with distinct ids, parsing only the annotation files whose
+    (mtime, size) changed. Images it already holds that are not in images
+    are kept. Returns the manifest and the number of annotation files parsed."""
+    stamps = np.empty((len(images), 2), dtype=np.float64)
+    for i, (image_id, annotation, image) in enumerate(images):
+        st = os.stat(annotation)
+        stamps[i] = st.st_mtime, st.st_size
+
+    old = load_manifest(path) if os.path.isfile(path) else None
+    rows = np.full(len(images), -1, dtype=np.int64)
+    if old is not None:
+        for i, (image_id, annotation, image) in enumerate(images):
+            j = old.index.get(image_id, -1)
+            if j >= 0 and (old.stamps[j] == stamps[i]).all():
+                rows[i] = j
+    stale = np.nonzero(rows < 0)[0]
+    if old is not None and len(stale) == 0:
+        return old, 0
+
+    files = [images[i][1] for i in stale]
+    if jobs == 1 or len(files) < 64:
+        parsed = [parse_annotation(f) for f in files]
+    else:
+        pool = multiprocessing.Pool(jobs)
+        parsed = pool.map(parse_annotation, files, chunksize=64)
+        pool.close()
+        pool.join()
+    parsed = dict(zip(stale, parsed))
+
+    # images not asked for stay as they were
+    ids = [image_id for image_id, annotation, image in images]
+    paths = [image for image_id, annotation, image in images]
+    if old is not None:
+        seen = set(ids)
+        extra = [j for j, x in enumerate(old.ids) if x not in seen]
+        ids += [old.ids[j] for j in extra]
+        paths += [old.paths[j] for j in extra]
+        rows = np.concatenate([rows, extra]).astype(np.int64)
+        stamps = np.concatenate([stamps, old.stamps[extra].reshape(-1, 2)])
+
+    labels = dict((x, k) for k, x in enumerate(old.labels)) if old is not None else {}
+    sizes = np.empty((len(ids), 2), dtype=np.int32)
+    label, bbox, difficult, counts = [], [], [], []
+    for i in range(len(ids)):
+        if rows[i] >= 0:
+            sizes[i] = old.sizes[rows[i]]
+            l, b, d = old.objects(rows[i])
+        else:
+            sizes[i], objects = parsed[i]
+            l = np.array([labels.setdefault(x[0], len(labels)) for x in objects], dtype=np.int32)
+            b = np.array([x[2] for x in objects], dtype=np.float64).reshape(-1, 4)
+            d = np.array([x[1] for x in objects], dtype=np.bool)
+        label.append(l)
+        bbox.append(b)
+        difficult.append(d)
+        counts.append(len(l))
+
+    manifest = Manifest(
+        ids=np.array(ids, dtype=np.str_).reshape(-1),
+        paths=np.array(paths, dtype=np.str_).reshape(-1),
+        sizes=sizes,
+        stamps=stamps,
+        offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        labels=np.array(sorted(labels, key=labels.get), dtype=np.str_).reshape(-1),
+        label=np.concatenate(label + [np.zeros(0, dtype=np.int32)]),
+        bbox=np.concatenate(bbox + [np.zeros((0, 4), dtype=np.float64)]),
+        difficult=np.concatenate(difficult + [np.zeros(0, dtype=np.bool)]))
+    manifest.save(path)
+    return manifest, len(stale)
+
+def parse_args():
+    import voc_label
+    parser = argparse.ArgumentParser(description='Build or update the dataset manifest of a VOC devkit')
+    parser.add_argument('--devkit', default='VOCdevkit', help='VOCdevkit directory')
+    parser.add_argument('--sets', default=','.join('%s_%s'%s for s in voc_label.sets),
+            help='comma separated <year>_<image set> list')
+    parser.add_argument('--out', default=None, help='manifest path, <devkit>/manifest.npz by default')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='worker processes, all cores by default')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    sets = [tuple(s.split('_', 1)) for s in args.sets.split(',')]
+    manifest, parsed = build_manifest(args.devkit, sets, args.out, args.jobs)
+    print '%d images, %d objects, %d annotations parsed'%(len(manifest.ids), len(manifest.label), parsed)
@@ -0,0 +1,7 @@
+#!/bin/bash
+#CPU-only benchmark of the python inference paths, run from shell/
+#extra arguments go to python/bench.py, e.g. --baseline ../results/bench.json
+cd ..
+mkdir -p obj-cpu
+make GPU=0 CUDNN=0 OPENCV=0 OBJDIR=./obj-cpu/ SLIB=libdarknet-cpu.so libdarknet-cpu.so || exit 1
+python python/bench.py --so ./libdarknet-cpu.so "$@"
@@ -66,19 +66,82 @@ size_t get_current_batch(network *net)
     return batch_num;
 }
 
+//lrt add
+//the buffers carrying a recurrent layer's state from one forward pass to
+//the next, a row of *size floats per sequence of the batch; returns how many
+static int recurrent_state(layer l, float **cpu, float **gpu, int *size)
+{
+    int n = 0;
+    *size = l.outputs;
+    switch(l.type){
+        case CRNN:
+            *size = l.hidden;
+            //fall through
+        case RNN:
+        case GRU:
+            cpu[0] = l.state;
+            #ifdef GPU
+            gpu[0] = l.state_gpu;
+            #endif
+            n = 1;
+            break;
+        case LSTM:
+            cpu[0] = l.h_cpu;
+            cpu[1] = l.c_cpu;
+            #ifdef GPU
+            gpu[0] = l.h_gpu;
+            gpu[1] = l.c_gpu;
+            #endif
+            n = 2;
+            break;
+        default:
+            break;
+    }
+    return n;
+}
+
+//lrt add
+//clear the CPU state too, without a GPU reset_rnn did nothing
 void reset_network_state(network *net, int b)
 {
-    int i;
+    int i, j, n, size;
+    float *cpu[2] = {0}, *gpu[2] = {0};
     for (i = 0; i < net->n; ++i) {
-        #ifdef GPU
-        layer l = net->layers[i];
-        if(l.state_gpu){
-            fill_gpu(l.outputs, 0, l.state_gpu + l.outputs*b, 1);
+        n = recurrent_state(net->layers[i], cpu, gpu, &size);
+        for (j = 0; j < n; ++j) {
+            if(cpu[j]) fill_cpu(size, 0, cpu[j] + size*b, 1);
+            #ifdef GPU
+            if(gpu[j]) fill_gpu(size, 0, gpu[j] + size*b, 1);
+            #endif
         }
-        if(l.h_gpu){
-            fill_gpu(l.outputs, 0, l.h_gpu + l.outputs*b, 1);
+    }
+}
+
+//lrt add
+//state row i of every recurrent layer becomes what row index[i] was, for
+//i < n, so sequences of a batch can be dropped or forked mid generation
+void reorder_network_state(network *net, int *index, int n)
+{
+    int i, j, k, b, size;
+    float *cpu[2] = {0}, *gpu[2] = {0};
+    for (i = 0; i < net->n; ++i) {
+        layer l = net->layers[i];
+        k = recurrent_state(l, cpu, gpu, &size);
+        for (j = 0; j < k; ++j) {
+            if(!cpu[j]) continue;
+            #ifdef GPU
+            if(gpu[j]) cuda_pull_array(gpu[j], cpu[j], size*l.batch);
+            #endif
+            float *old = calloc(size*l.batch, sizeof(float));
+            memcpy(old, cpu[j], size*l.batch*sizeof(float));
+            for (b = 0; b < n; ++b) {
+                memcpy(cpu[j] + b*size, old + index[b]*size, size*sizeof(float));
+            }
+            free(old);
+            #ifdef GPU
+            if(gpu[j]) cuda_push_array(gpu[j], cpu[j], size*l.batch);
+            #endif
         }
-        #endif
     }
 }
 
@@ -566,6 +629,43 @@ detection *get_network_boxes(network *net, int w, int h, float thresh, float hie
     return dets;
 }
 
+//lrt add
+//point the output layers at image b of a batched forward pass, and back
+//with -b; batch 2 would trigger the flipped-average path, so they see 1
+static void shift_batch_outputs(network *net, int b, int batch)
+{
+    int j;
+    for(j = 0; j < net->n; ++j){
+        layer *l = &net->layers[j];
+        if(l->type == YOLO || l->type == REGION || l->type == DETECTION){
+            l->output += b*l->outputs;
+            l->batch = batch;
+        }
+    }
+}
+
+//lrt add
+//fill_network_boxes for image b of a batched forward pass, into dets from
+//make_network_boxes(net, -1, ...) which hold every box; returns the count
+int fill_network_boxes_batch(network *net, int b, int w, int h, float thresh, float hier, int *map, int relative, detection *dets)
+{
+    shift_batch_outputs(net, b, 1);
+    int num = num_detections(net, thresh);
+    fill_network_boxes(net, w, h, thresh, hier, map, relative, dets);
+    shift_batch_outputs(net, -b, net->batch);
+    return num;
+}
+
+//lrt add
+//gather the per-box prob rows into one n x classes matrix
+void get_detection_probs(detection *dets, int n, int classes, float *probs)
+{
+    int i;
+    for(i = 0; i < n; ++i){
+        memcpy(probs + i*classes, dets[i].prob, classes*sizeof(float));
+    }
+}
+
 void free_detections(detection *dets, int n)
 {
     int i;